@@ -1,35 +1,65 @@
-from torch.utils.data import IterableDataset, get_worker_info, StackDataset
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info, StackDataset
+import numpy as np
+import torch
 import torchaudio
+from torchaudio.functional import resample
 
 from glob import glob
-import math
+import heapq
+import json
 import os.path
+import random
+import wave
+
+
+# int16 stores hold round(x * INT16_SCALE), clipped, and read back as x / INT16_SCALE
+INT16_SCALE = 32768
+
+
+def wav_duration(path: str) -> float:
+    """Duration in seconds, read from the WAV header only."""
+    try:
+        with wave.open(path, "rb") as f:
+            return f.getnframes() / f.getframerate()
+    except wave.Error:  # e.g. float WAVs, which the wave module rejects
+        info = torchaudio.info(path)
+        return info.num_frames / info.sample_rate
+
+
+def balanced_shards(lengths: list[float], num_shards: int) -> list[list[int]]:
+    """
+    Split item indices into `num_shards` shards with close to equal total
+    length, assigning the longest items first to the lightest shard. Each
+    shard keeps its indices in increasing order.
+    """
+    shards = [[] for _ in range(num_shards)]
+    heap = [(0., shard) for shard in range(num_shards)]
+    for i in sorted(range(len(lengths)), key=lambda i: (-lengths[i], i)):
+        total, shard = heapq.heappop(heap)
+        shards[shard].append(i)
+        heapq.heappush(heap, (total + lengths[i], shard))
+    return [sorted(shard) for shard in shards]
 
 
 class ReadWavsDataset(IterableDataset):
     files: list[str]
+    durations: list[float]
 
     def __init__(self, directory: str):
         super().__init__()
         assert os.path.isdir(directory), "ReadWavsDataset requires a directory as input"
-        self.files = glob(os.path.join(directory, "*.wav"))
+        self.files = sorted(glob(os.path.join(directory, "*.wav")))
+        self.durations = [wav_duration(f) for f in self.files]
 
     def __iter__(self):
-        start = 0
-        end = len(self.files)
-
-        # worker splitting code sourced from PyTorch docs
         if worker := get_worker_info():  # in a worker process
-            # split workload
-            per_worker = int(math.ceil((end - start) / float(worker.num_workers)))
-            worker_id = worker.id
-            iter_start = start + worker_id * per_worker
-            iter_end = min(iter_start + per_worker, end)
+            # split by total audio duration rather than by file count
+            shard = balanced_shards(self.durations, worker.num_workers)[worker.id]
+            files = [self.files[i] for i in shard]
         else:  # single-process data loading, return the full iterator
-            iter_start = start
-            iter_end = end
+            files = self.files
 
-        return iter(map(torchaudio.load, self.files[iter_start:iter_end]))
+        return iter(map(torchaudio.load, files))
 
 
 def valentini_set(name: str):
@@ -47,3 +77,161 @@ def trainset():
         valentini_set("clean_trainset_28spk_wav"),
         valentini_set("noisy_trainset_28spk_wav"),
     )
+
+
+def build_index(clean_name: str, noisy_name: str, sample_rate: int = 16000, dtype: str = "float32"):
+    """
+    Decode and resample every clean/noisy pair once into a single contiguous
+    raw file of `dtype` samples (float32 or int16), plus a JSON index holding
+    the file names and the offset and length of every clip in it. Pairs are
+    matched by file name, and a file missing from either side is an error.
+    Returns the path of the index.
+    """
+    root = os.path.dirname(__file__)
+    clean_dir = os.path.join(root, clean_name)
+    noisy_dir = os.path.join(root, noisy_name)
+    clean_names = set(map(os.path.basename, glob(os.path.join(clean_dir, "*.wav"))))
+    noisy_names = set(map(os.path.basename, glob(os.path.join(noisy_dir, "*.wav"))))
+    if clean_names != noisy_names:
+        unmatched = sorted(clean_names ^ noisy_names)
+        raise ValueError(f"{len(unmatched)} files are not paired, e.g. {unmatched[:5]}")
+    names = sorted(clean_names)
+
+    base = os.path.join(root, f"{noisy_name}-{sample_rate}-{dtype}")
+    index = dict(names=names, sample_rate=sample_rate, dtype=dtype, data=os.path.basename(base) + ".raw",
+                 clean_offsets=[], clean_lengths=[], noisy_offsets=[], noisy_lengths=[])
+    if dtype == "int16":
+        index["scale"] = INT16_SCALE
+    offset = 0
+    # both files go through a per-process temp file and a rename, so concurrent
+    # builders do not clobber each other and a crash never leaves a partial one
+    tmp = f".{os.getpid()}.tmp"
+    with open(base + ".raw" + tmp, "wb") as data:
+        for name in names:
+            for kind, directory in (("clean", clean_dir), ("noisy", noisy_dir)):
+                wav, fs = torchaudio.load(os.path.join(directory, name))
+                wav = resample(wav, fs, sample_rate).mean(0).numpy()
+                if dtype == "int16":
+                    wav = np.clip(np.round(wav * INT16_SCALE), -32768, 32767)
+                wav.astype(dtype).tofile(data)
+                index[f"{kind}_offsets"].append(offset)
+                index[f"{kind}_lengths"].append(len(wav))
+                offset += len(wav)
+    os.replace(base + ".raw" + tmp, base + ".raw")
+    # the index last, so it only exists once its data is complete
+    with open(base + ".json" + tmp, "w") as f:
+        json.dump(index, f)
+    os.replace(base + ".json" + tmp, base + ".json")
+    return base + ".json"
+
+
+class IndexedPairsDataset(Dataset):
+    """
+    Map-style dataset of (noisy, clean) pairs, each of shape [1, length],
+    read from the memory-mapped store written by `build_index` (built on first
+    use). Worker processes each map the file and slice clips out of it, so
+    float32 stores are read without decoding or copying.
+    """
+    def __init__(self, clean_name: str, noisy_name: str, sample_rate: int = 16000, dtype: str = "float32"):
+        super().__init__()
+        path = os.path.join(os.path.dirname(__file__), f"{noisy_name}-{sample_rate}-{dtype}.json")
+        if not os.path.exists(path):
+            path = build_index(clean_name, noisy_name, sample_rate, dtype)
+        with open(path) as f:
+            self.index = json.load(f)
+        self.path = os.path.join(os.path.dirname(path), self.index["data"])
+        self.names = self.index["names"]
+        self.sample_rate = sample_rate
+        self._data = None
+
+    @property
+    def lengths(self) -> list[int]:
+        return self.index["noisy_lengths"]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        # pickling a memmap copies it, so every worker maps the file itself
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    def _clip(self, kind: str, i: int) -> torch.Tensor:
+        if self._data is None:
+            # copy on write, so tensors can be built without a copy or a warning
+            self._data = np.memmap(self.path, dtype=self.index["dtype"], mode="c")
+        offset = self.index[f"{kind}_offsets"][i]
+        clip = torch.from_numpy(self._data[offset:offset + self.index[f"{kind}_lengths"][i]])
+        if clip.dtype == torch.int16:
+            # stores built before the scale was recorded used 32767
+            clip = clip.float() / self.index.get("scale", 32767)
+        return clip.unsqueeze(0)
+
+    def __getitem__(self, i: int):
+        return self._clip("noisy", i), self._clip("clean", i)
+
+
+def indexed_testset(sample_rate: int = 16000, dtype: str = "float32"):
+    return IndexedPairsDataset("clean_testset_wav", "noisy_testset_wav", sample_rate, dtype)
+
+
+def indexed_trainset(sample_rate: int = 16000, dtype: str = "float32"):
+    return IndexedPairsDataset("clean_trainset_28spk_wav", "noisy_trainset_28spk_wav", sample_rate, dtype)
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler grouping items of similar length, to minimize padding.
+    Items are sorted by length and cut into batches holding at most
+    `max_batch_samples` samples once padded to their longest item (and at
+    most `batch_size` items, if given). Batches therefore carry about the
+    same amount of audio, which also balances the DataLoader workers they
+    are dealt to. With `shuffle`, the batch order changes every epoch (see
+    `set_epoch`) while batches stay length homogeneous.
+    """
+    def __init__(self, lengths: list[int], max_batch_samples: int, batch_size: int | None = None,
+                 shuffle: bool = False, seed: int = 0):
+        super().__init__()
+        self.batches = []
+        batch = []
+        for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            # sorted ascending, so the new item is the longest of the batch
+            too_long = (len(batch) + 1) * lengths[i] > max_batch_samples
+            too_many = batch_size is not None and len(batch) == batch_size
+            if batch and (too_long or too_many):
+                self.batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            self.batches.append(batch)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        order = list(range(len(self.batches)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        return iter([self.batches[i] for i in order])
+
+
+def collate_padded(batch):
+    """
+    Collate (noisy, clean) pairs of shape [1, length] into zero padded
+    [batch, 1, max_length] tensors, plus the original lengths, which
+    `Demucs.forward` uses to normalize each item over its real samples.
+    """
+    lengths = torch.tensor([noisy.shape[-1] for noisy, _ in batch])
+    noisy = torch.zeros(len(batch), 1, int(lengths.max()))
+    clean = torch.zeros(len(batch), 1, int(lengths.max()))
+    for i, (n, c) in enumerate(batch):
+        noisy[i, :, :n.shape[-1]] = n
+        clean[i, :, :c.shape[-1]] = c
+    return noisy, clean, lengths
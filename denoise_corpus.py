@@ -0,0 +1,181 @@
+"""
+Denoise every WAV file under a directory tree into a mirrored output tree.
+
+    python denoise_corpus.py recordings/ denoised/ --variant dynamic_only --jobs 4
+
+Files are spread over --jobs worker processes, each of which loads the model
+once and runs --threads torch threads (by default the cores are split evenly
+between the workers). Long recordings are denoised in overlapping chunks, so
+memory does not grow with their length. Every finished file is appended to
+a JSONL manifest (default: <output>/manifest.jsonl) with its status,
+duration and real-time factor; rerunning the same command skips the files
+already marked ok, so an interrupted run picks up where it stopped.
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+from torchaudio.functional import resample
+
+import wav_parser
+from denoising import variants
+from denoising.inference import iter_denoise_chunked
+
+CALIBRATION_CACHE = ".calibration"
+# input samples of context on each side of a resampled block, more than the
+# half width of torchaudio's default sinc kernel for any common rate pair
+RESAMPLE_CONTEXT = 512
+
+_model = None
+
+
+def _init_worker(variant: str, threads: int):
+    global _model
+    torch.set_num_threads(threads)
+    _model = variants.build_variant(variant, calibration_cache=CALIBRATION_CACHE)
+    _model.eval()
+
+
+def resample_blocks(blocks, orig_freq: int, new_freq: int, context: int = RESAMPLE_CONTEXT):
+    """
+    Resample a stream of 1d blocks one block at a time. Each block is resampled
+    together with `context` input samples on either side and the context is cut
+    from the output again, so the result matches resampling the whole signal
+    while only about one block is held in memory.
+    """
+    divisor = math.gcd(orig_freq, new_freq)
+    # block boundaries on multiples of `step` input samples land exactly on output samples
+    step, out_step = orig_freq // divisor, new_freq // divisor
+    context = -(-context // step) * step
+    left, pending = torch.zeros(0), torch.zeros(0)
+    for block in blocks:
+        pending = torch.cat([pending, block])
+        usable = (pending.shape[-1] - context) // step * step
+        if usable <= 0:
+            continue
+        out = resample(torch.cat([left, pending[:usable + context]]), orig_freq, new_freq)
+        start = left.shape[-1] // step * out_step
+        yield out[start:start + usable // step * out_step]
+        left = torch.cat([left, pending[:usable]])[-context:]
+        pending = pending[usable:]
+    if pending.shape[-1]:
+        out = resample(torch.cat([left, pending]), orig_freq, new_freq)
+        yield out[left.shape[-1] // step * out_step:]
+
+
+def denoise_file(source: str, target: str, window: float, hop: float) -> dict:
+    start = time.perf_counter()
+    partial = f"{target}.{os.getpid()}.tmp"
+    try:
+        wav = wav_parser.WavFile(source)
+        sample_rate = _model.sample_rate
+        audio = (torch.from_numpy(block) for block in wav.blocks(mono=True))
+        num_frames = wav.num_frames
+        if wav.sample_rate != sample_rate:
+            audio = resample_blocks(audio, wav.sample_rate, sample_rate)
+            num_frames = math.ceil(wav.num_frames * sample_rate / wav.sample_rate)
+
+        os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+        # written next to the target and renamed, so a killed worker never leaves a truncated file behind
+        with open(partial, "wb") as f:
+            f.write(wav_parser.wav_header(num_frames, sample_rate))
+            for chunk in iter_denoise_chunked(_model, audio, window, hop):
+                f.write(wav_parser.to_pcm16(chunk.numpy()))
+        os.replace(partial, target)
+    except Exception as e:
+        if os.path.exists(partial):
+            os.remove(partial)
+        return dict(status="error", error=f"{type(e).__name__}: {e}")
+    elapsed = time.perf_counter() - start
+    return dict(status="ok", duration=wav.duration, seconds=elapsed, rtf=elapsed / max(wav.duration, 1e-9))
+
+
+def load_manifest(path: str) -> dict:
+    """Last recorded entry of every file in the manifest."""
+    entries = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line cut short by an interrupted run
+                    continue
+                entries[entry["file"]] = entry
+    return entries
+
+
+def find_wavs(root: str, exclude: str) -> list[str]:
+    files = []
+    for directory, _, names in os.walk(root):
+        # the output tree may live inside the input tree
+        if os.path.commonpath([os.path.abspath(directory), os.path.abspath(exclude)]) == os.path.abspath(exclude):
+            continue
+        files += [os.path.relpath(os.path.join(directory, name), root)
+                  for name in names if name.lower().endswith(".wav")]
+    return sorted(files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Denoise a directory tree of WAV files.")
+    parser.add_argument("input", help="input directory, searched recursively")
+    parser.add_argument("output", help="output directory, mirroring the input tree")
+    parser.add_argument("--variant", default="pretrained", help=f"one of {', '.join(variants.VARIANTS)}")
+    parser.add_argument("--jobs", type=int, default=min(4, os.cpu_count() or 1), help="worker processes")
+    parser.add_argument("--threads", type=int, help="torch threads per worker (default: cores / jobs)")
+    parser.add_argument("--window", type=float, default=10., help="chunk length in seconds")
+    parser.add_argument("--hop", type=float, default=9., help="chunk hop in seconds")
+    parser.add_argument("--manifest", help="default: <output>/manifest.jsonl")
+    parser.add_argument("--retry-errors", action="store_true", help="also redo files that failed before")
+    args = parser.parse_args()
+
+    if args.variant not in variants.VARIANTS:
+        parser.error(f"unknown variant {args.variant}")
+    manifest = args.manifest or os.path.join(args.output, "manifest.jsonl")
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.jobs)
+
+    done = load_manifest(manifest)
+    files = []
+    for file in find_wavs(args.input, args.output):
+        entry = done.get(file)
+        if entry is not None and entry.get("variant") != args.variant:
+            entry = None
+        if entry is not None and entry["status"] == "ok" and os.path.exists(os.path.join(args.output, file)):
+            continue
+        if entry is not None and entry["status"] == "error" and not args.retry_errors:
+            continue
+        files.append(file)
+    print(f"{len(files)} files to denoise, {len(done)} already in {manifest}")
+    if not files:
+        return
+    # largest first, so one long recording does not finish alone at the end
+    files.sort(key=lambda file: os.path.getsize(os.path.join(args.input, file)), reverse=True)
+
+    os.makedirs(os.path.dirname(manifest) or ".", exist_ok=True)
+    pool = ProcessPoolExecutor(args.jobs, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker, initargs=(args.variant, threads))
+    total, failed = 0., 0
+    with pool, open(manifest, "a") as log:
+        futures = {pool.submit(denoise_file, os.path.join(args.input, file), os.path.join(args.output, file),
+                               args.window, args.hop): file for file in files}
+        for count, future in enumerate(as_completed(futures), 1):
+            entry = dict(file=futures[future], variant=args.variant, **future.result())
+            # one writer, one line per file, flushed so a crash loses at most the files in flight
+            log.write(json.dumps(entry) + "\n")
+            log.flush()
+            if entry["status"] == "ok":
+                total += entry["duration"]
+                print(f"[{count}/{len(files)}] {entry['file']}: {entry['duration']:.1f}s, RTF {entry['rtf']:.3f}")
+            else:
+                failed += 1
+                print(f"[{count}/{len(files)}] {entry['file']}: {entry['error']}")
+    print(f"denoised {total / 3600:.2f} hours of audio, {failed} failures")
+
+
+if __name__ == "__main__":
+    main()
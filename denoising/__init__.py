@@ -1 +1 @@
-from . import demucs, quantized_demucs
+from . import registry, demucs, quantized_demucs, streaming, inference, variants, profiling, training, pruning, workspace, compiled, precision, qat, distillation
@@ -0,0 +1,114 @@
+"""
+Compiled inference for server deployments.
+
+`CompiledDemucs` compiles a model once (frozen TorchScript with graph fusion,
+or `torch.compile`) and runs it on a fixed set of input shapes: lengths are
+padded up to the nearest bucket, each a `valid_length` so the model adds no
+padding of its own, and batches up to the nearest allowed batch size. Every
+shape is warmed up at construction, so requests never trigger a
+recompilation. Audio longer than the largest bucket goes through
+`denoise_chunked` with windows of exactly that bucket.
+"""
+import bisect
+
+import torch
+from torch import nn, Tensor
+
+from typing import Optional, Sequence
+
+from .inference import denoise_chunked
+
+BACKENDS = ("torchscript", "inductor")
+
+
+def compile_model(model: nn.Module, backend: str = "torchscript"):
+    """
+    `model` compiled with `backend`: "torchscript" freezes the scripted model
+    (weights become constants) and applies `optimize_for_inference` (conv
+    folding, fusion); "inductor" uses `torch.compile` with static shapes.
+    """
+    model.eval()
+    if backend == "torchscript":
+        frozen = torch.jit.freeze(torch.jit.script(model))
+        return torch.jit.optimize_for_inference(frozen)
+    if backend == "inductor":
+        return torch.compile(model, dynamic=False)
+    raise ValueError(f"backend needs to be in {list(BACKENDS)}")
+
+
+class CompiledDemucs:
+    """
+    Args:
+        - model (nn.Module): a `Demucs` or `QuantizedDemucs`.
+        - bucket_seconds (list of float): input lengths to compile for, in
+            seconds; each is rounded up to a valid length.
+        - batch_sizes (list of int): batch sizes to compile for. Larger
+            batches are split.
+        - backend (str): one of `BACKENDS`.
+        - warmup (int): runs per shape at construction.
+    """
+    def __init__(self, model: nn.Module, bucket_seconds: Sequence[float] = (1., 2., 4., 8.),
+                 batch_sizes: Sequence[int] = (1,), backend: str = "torchscript", warmup: int = 2):
+        self.model = model.eval()
+        self.sample_rate = model.sample_rate
+        self.total_stride = model.total_stride
+        self.buckets = sorted({model.valid_length(int(s * self.sample_rate)) for s in bucket_seconds})
+        self.batch_sizes = sorted(set(batch_sizes))
+        if backend == "inductor":
+            # every (batch, length) pair is compiled once, allow that many graphs
+            config = torch._dynamo.config
+            shapes = len(self.buckets) * len(self.batch_sizes)
+            for name in ("cache_size_limit", "recompile_limit"):
+                if hasattr(config, name):
+                    setattr(config, name, max(getattr(config, name), shapes))
+        self.compiled = compile_model(model, backend)
+        self.warmup(warmup)
+
+    def valid_length(self, length: int) -> int:
+        return self.model.valid_length(length)
+
+    def warmup(self, runs: int = 2):
+        """Run every bucketed shape `runs` times, so compilation and graph specialization happen now."""
+        with torch.no_grad():
+            for batch in self.batch_sizes:
+                for length in self.buckets:
+                    x = torch.randn(batch, 1, length)
+                    lengths = torch.full((batch,), length)
+                    for _ in range(runs):
+                        self.compiled(x, lengths)
+
+    def _run(self, mix: Tensor, lengths: Tensor, bucket: int) -> Tensor:
+        batch, channels, length = mix.shape
+        index = bisect.bisect_left(self.batch_sizes, batch)
+        if index == len(self.batch_sizes):
+            size = self.batch_sizes[-1]
+            return torch.cat([self._run(mix[i:i + size], lengths[i:i + size], bucket)
+                              for i in range(0, batch, size)])
+        padded_batch = self.batch_sizes[index]
+        x = mix.new_zeros(padded_batch, channels, bucket)
+        x[:batch, :, :length] = mix
+        padded_lengths = torch.full((padded_batch,), length)
+        padded_lengths[:batch] = lengths
+        with torch.no_grad():
+            return self.compiled(x, padded_lengths)[:batch, :, :length]
+
+    def __call__(self, mix: Tensor, lengths: Optional[Tensor] = None) -> Tensor:
+        """Denoise `mix` of shape [B, C, T] (or [B, T]), like `Demucs.forward`."""
+        if mix.dim() == 2:
+            mix = mix.unsqueeze(1)
+        batch, channels, length = mix.shape
+        if lengths is None:
+            lengths = torch.full((batch,), length)
+
+        index = bisect.bisect_left(self.buckets, length)
+        if index < len(self.buckets):
+            return self._run(mix, lengths, self.buckets[index])
+
+        # longer than every bucket: overlapping chunks of the largest bucket,
+        # each of which goes back through the compiled path
+        window = self.buckets[-1] / self.sample_rate
+        out = mix.new_zeros(batch, channels, length)
+        for i in range(batch):
+            item = mix[i, :, :int(lengths[i])].mean(dim=0)
+            out[i, :, :item.shape[-1]] = denoise_chunked(self, item, window, 0.9 * window)
+        return out
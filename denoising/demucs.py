@@ -3,12 +3,52 @@ DEMUCS model taken from facebookresearch/denoiser;; We need the exact class
 definition so we can easily load in pretrained models, if needed.
 """
 import torch
-from torch import hub, nn, Tensor
+from torch import nn, Tensor
 from torch.nn import functional as F
-from torchaudio.functional import resample
+from torchaudio.transforms import Resample
 import math
 from typing import Optional, Tuple
 
+from . import registry
+
+class Resampler(Resample):
+    """
+    `Resample` whose sinc kernel is a non-persistent buffer. torchaudio
+    registers it as a persistent one, which would put `kernel` keys in the
+    state dict that the facebookresearch/denoiser checkpoints do not have.
+    """
+    def __init__(self, orig_freq: int, new_freq: int):
+        super().__init__(orig_freq, new_freq)
+        self.register_buffer("kernel", self.kernel, persistent=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved while the kernel was persistent still carry it;
+        # it only depends on the rates, so the one built here is kept
+        state_dict.pop(prefix + "kernel", None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+def resampler(orig_freq: int, new_freq: int) -> nn.Module:
+    """
+    Module resampling from `orig_freq` to `new_freq`. The sinc kernel is built
+    once here, so it is not rebuilt on every call, and is baked into
+    TorchScript; it is not saved in checkpoints (see `Resampler`).
+    """
+    if orig_freq == new_freq:
+        return nn.Identity()
+    return Resampler(orig_freq, new_freq)
+
+def masked_std(x: Tensor, lengths: Tensor) -> Tensor:
+    """
+    Unbiased std over the last dimension of `x`, of shape [B, C, T], only
+    counting the first `lengths[b]` samples of each batch item.
+    """
+    lengths = lengths.view(-1, 1, 1)
+    mask = torch.arange(x.shape[-1], device=x.device) < lengths
+    count = lengths.to(x.dtype)
+    mean = (x * mask).sum(dim=-1, keepdim=True) / count
+    var = (((x - mean) * mask) ** 2).sum(dim=-1, keepdim=True) / (count - 1).clamp(min=1)
+    return var.sqrt()
+
 # BEGIN (mostly) UNORIGINAL CODE
 
 class BLSTM(nn.Module):
@@ -77,6 +117,8 @@ class Demucs(nn.Module):
         self.resample = resample
         self.normalize = normalize
         self.sample_rate = sample_rate
+        self.upsample = resampler(sample_rate, sample_rate * resample)
+        self.downsample = resampler(sample_rate * resample, sample_rate)
 
         self.encoder = nn.ModuleList()
         self.decoder = nn.ModuleList()
@@ -130,13 +172,16 @@ class Demucs(nn.Module):
     def total_stride(self):
         return self.stride ** self.depth // self.resample
 
-    def forward(self, mix):
+    def forward(self, mix, lengths: Optional[Tensor] = None):
         if mix.dim() == 2:
             mix = mix.unsqueeze(1)
 
         if self.normalize:
             mono = mix.mean(dim=1, keepdim=True)
-            std = mono.std(dim=-1, keepdim=True)
+            if lengths is None:
+                std = mono.std(dim=-1, keepdim=True)
+            else:
+                std = masked_std(mono, lengths)
             mix = mix / (self.floor + std)
         else:
             std = torch.tensor([1])
@@ -148,10 +193,7 @@ class Demucs(nn.Module):
         # elif self.resample == 4:
         #     x = upsample2(x)
         #     x = upsample2(x)
-        if self.resample == 2:
-          x = resample(x, self.sample_rate, self.sample_rate * 2)
-        elif self.resample == 4:
-          x = resample(x, self.sample_rate, self.sample_rate * 4)
+        x = self.upsample(x)
 
         skips = []
         for encode in self.encoder:
@@ -169,36 +211,19 @@ class Demucs(nn.Module):
         # elif self.resample == 4:
         #     x = downsample2(x)
         #     x = downsample2(x)
-        if self.resample == 2:
-          x = resample(x, self.sample_rate *2, self.sample_rate)
-        elif self.resample == 4:
-          x = resample(x, self.sample_rate *4, self.sample_rate)
+        x = self.downsample(x)
         x = x[..., :length]
         return std * x
 
 # END UNORIGINAL CODE
 
-ROOT = "https://dl.fbaipublicfiles.com/adiyoss/denoiser/"
-PRETRAINED_URLS = {
-    'dns48': ROOT + "dns48-11decc9d8e3f0998.th",
-    'dns64': ROOT + "dns64-a7761ff99a7d5bb6.th",
-    'master64': ROOT + "master64-8a5dfb4bb92753dd.th",
-    'valentini': ROOT + 'valentini_nc-93fc4337.th',  # Non causal
-}
+PRETRAINED_URLS = {name: registry.ROOT + entry['file'] for name, entry in registry.PRETRAINED.items()}
 
 def load_pretrained_demucs(name: str):
-    if name not in PRETRAINED_URLS:
-        raise ValueError(f'pretrained name needs to be in {list(PRETRAINED_URLS.keys())}')
-    if name == 'dns48':
-        kwargs = dict(hidden=48)
-    elif name == 'dns64' or name == 'master64':
-        kwargs = dict(hidden=64)
-    else:
-        kwargs = dict(hidden=64, causal=False, stride=2, resample=2)
-    state= hub.load_state_dict_from_url(PRETRAINED_URLS[name], map_location='cpu')
-    model = Demucs(**kwargs, sample_rate = 16000)
-    model.load_state_dict(state)
+    path, kwargs = registry.resolve(name)
+    state = registry.load_state_dict(path)
+    model = Demucs(**{'sample_rate': 16000, **kwargs})
+    # assign keeps the memory-mapped tensors, so processes share their pages
+    model.load_state_dict(state, assign=True)
 
     return model
-    
-
@@ -0,0 +1,59 @@
+"""
+Knowledge distillation of smaller `Demucs` students from a pretrained
+teacher.
+
+Students are shallower, narrower or resample less than the pretrained
+models (the 4x upsample alone quadruples the convolution work). They are
+trained on the teacher's output as well as the clean target, with the same
+waveform + multi resolution STFT loss as fine-tuning.
+"""
+import torch
+from torch import nn, Tensor
+
+from typing import Any, Callable, Dict, Iterable
+
+from . import training
+from .demucs import Demucs
+
+# student configurations, as Demucs kwargs on top of the teacher's
+STUDENTS: Dict[str, Dict[str, Any]] = {
+    # same depth, half the upsampling
+    "student_48_r2": dict(hidden=48, depth=5, resample=2),
+    # narrower, half the upsampling
+    "student_32_r2": dict(hidden=32, depth=5, resample=2),
+    # narrower and one stage shallower, no upsampling
+    "student_32_d4_r1": dict(hidden=32, depth=4, resample=1),
+    # smallest, for the lowest end devices
+    "student_24_d4_r1": dict(hidden=24, depth=4, resample=1),
+}
+
+
+def student_kwargs(teacher: Demucs, config: Dict[str, Any]) -> Dict[str, Any]:
+    """Constructor kwargs of a student: `config` over the teacher's causality, kernel, stride and rate."""
+    return dict(causal=teacher.causal, kernel_size=teacher.kernel_size, stride=teacher.stride,
+                normalize=teacher.normalize, floor=teacher.floor, sample_rate=teacher.sample_rate, **config)
+
+
+def distillation_loss(teacher: nn.Module, alpha: float = 0.5,
+                      stft_weight: float = 1.) -> Callable[[nn.Module, training.Batch], Tensor]:
+    """
+    Loss for `training.finetune`: `alpha` times the distance to the teacher's
+    output plus `1 - alpha` times the distance to the clean target.
+    """
+    teacher.eval()
+
+    def loss(student: nn.Module, batch: training.Batch) -> Tensor:
+        noisy, clean, lengths = batch
+        with torch.no_grad():
+            target = teacher(noisy, lengths)
+        estimate = student(noisy, lengths)
+        return (alpha * training.waveform_loss(estimate, target, lengths, stft_weight)
+                + (1 - alpha) * training.waveform_loss(estimate, clean, lengths, stft_weight))
+    return loss
+
+
+def distill(teacher: Demucs, config: Dict[str, Any], batches: Iterable[training.Batch], steps: int,
+            lr: float = 3e-4, alpha: float = 0.5) -> Demucs:
+    """Train a new student with `config` (see `STUDENTS`) against `teacher`."""
+    student = Demucs(**student_kwargs(teacher, config))
+    return training.finetune(student, batches, steps, lr, loss_fn=distillation_loss(teacher, alpha))
@@ -0,0 +1,159 @@
+"""
+Offline inference helpers that sit on top of `Demucs.forward`.
+"""
+import math
+
+import torch
+from torch import nn, Tensor
+
+from typing import Iterable, Iterator, List, Sequence, Union
+
+# largest allowed difference between chunked (default window and hop) and
+# whole-file inference, relative to the whole-file output RMS; see
+# `chunked_deviation` and testing/chunked_tolerance.py
+CHUNKED_TOLERANCE = 0.05
+
+
+def denoise_batch(model: nn.Module, waveforms: Sequence[Tensor],
+                  batch_size: int = 16) -> List[Tensor]:
+    """
+    Denoise a list of mono waveforms of different lengths, each of shape
+    `[length]` or `[1, length]`.
+
+    Clips are sorted by length and grouped into buckets of `batch_size`, so
+    each bucket is padded once to the length of its longest clip. The model
+    normalizes every item by the std of its real samples only, and outputs
+    are trimmed back to the original lengths and returned in input order.
+
+    For causal models the padding does not change the result. Non causal
+    models (valentini) also see the trailing silence through the BiLSTM,
+    which the length bucketing keeps small.
+    """
+    order = sorted(range(len(waveforms)), key=lambda i: waveforms[i].shape[-1], reverse=True)
+    outputs: List[Tensor] = [torch.empty(0)] * len(waveforms)
+
+    with torch.no_grad():
+        for start in range(0, len(order), batch_size):
+            bucket = order[start:start + batch_size]
+            lengths = torch.tensor([waveforms[i].shape[-1] for i in bucket])
+            batch = torch.zeros(len(bucket), 1, int(lengths.max()))
+            for row, i in enumerate(bucket):
+                batch[row, 0, :lengths[row]] = waveforms[i].reshape(-1)
+
+            denoised = model(batch, lengths)
+            for row, i in enumerate(bucket):
+                out = denoised[row, :, :lengths[row]]
+                outputs[i] = out.reshape(waveforms[i].shape)
+
+    return outputs
+
+
+def _fade(length: int) -> Tensor:
+    """
+    Rising half of a sine squared window. It never reaches 0 and sums to 1
+    with its own reverse, so two crossfaded chunks keep unit gain.
+    """
+    return torch.sin(math.pi / 2 * (torch.arange(length) + 0.5) / length) ** 2
+
+
+def _as_mono(block) -> Tensor:
+    return torch.as_tensor(block, dtype=torch.float32).reshape(-1)
+
+
+def iter_denoise_chunked(model: nn.Module,
+                         audio: Union[Tensor, Iterable[Tensor]],
+                         window: float = 10.,
+                         hop: float = 9.) -> Iterator[Tensor]:
+    """
+    Denoise arbitrarily long mono audio in overlapping chunks, yielding the
+    denoised samples as soon as no later chunk can change them.
+
+    `audio` is either a whole waveform or an iterable of consecutive blocks
+    (e.g. read from disk), each of shape `[length]` or `[1, length]`.
+    `window` and `hop` are in seconds. The hop is rounded down to a multiple
+    of `total_stride` so every chunk lines up with the encoder frame grid, and
+    the window is rounded up to `valid_length` so no chunk gets padded.
+    Overlapping chunks are crossfaded over `window - hop` samples.
+
+    Peak memory is bounded by the window instead of the recording length.
+    Each chunk is normalized on its own, so outside of the crossfades the
+    output only differs from whole-file inference through that per-chunk
+    std, and inside them through the blend of two estimates. With the
+    default window and hop, the largest difference is required to stay
+    within `CHUNKED_TOLERANCE` (5%) of the whole-file output RMS for every
+    shipped variant; testing/chunked_tolerance.py measures it on the repo's
+    recordings and fails when a variant exceeds it.
+    """
+    if isinstance(audio, Tensor):
+        audio = [audio]
+    total_stride = model.total_stride
+    hop = max(total_stride, int(hop * model.sample_rate) // total_stride * total_stride)
+    window = model.valid_length(max(int(window * model.sample_rate), hop))
+    fade = min(window - hop, window // 2)
+
+    weight = torch.ones(window)
+    if fade > 0:
+        weight[:fade] = _fade(fade)
+        weight[-fade:] = _fade(fade).flip(0)
+
+    pending = torch.zeros(0)
+    out = torch.zeros(window)
+    norm = torch.zeros(window)
+    first = True
+
+    def run(chunk: Tensor, weight: Tensor):
+        length = chunk.shape[-1]
+        # no_grad is scoped to the call, it must not leak out of a suspended generator
+        with torch.no_grad():
+            denoised = model(chunk.view(1, 1, -1))[0, 0]
+        out[:length] += denoised * weight[:length]
+        norm[:length] += weight[:length]
+
+    for block in audio:
+        pending = torch.cat([pending, _as_mono(block)])
+        while pending.shape[-1] >= window:
+            chunk_weight = weight.clone()
+            if first and fade > 0:
+                chunk_weight[:fade] = 1
+            run(pending[:window], chunk_weight)
+            first = False
+
+            yield out[:hop] / norm[:hop]
+            out = torch.cat([out[hop:], torch.zeros(hop)])
+            norm = torch.cat([norm[hop:], torch.zeros(hop)])
+            pending = pending[hop:]
+
+    length = pending.shape[-1]
+    if length > 0:
+        # the last chunk has no right neighbour to fade into
+        chunk_weight = torch.ones(window)
+        if not first and fade > 0:
+            chunk_weight[:fade] = _fade(fade)
+        run(pending, chunk_weight)
+        yield out[:length] / norm[:length]
+
+
+def denoise_chunked(model: nn.Module, audio: Tensor,
+                    window: float = 10., hop: float = 9.) -> Tensor:
+    """
+    Same as `iter_denoise_chunked`, concatenated back into one waveform of
+    the input's shape.
+    """
+    if audio.numel() == 0:
+        # no chunks to concatenate
+        return audio.clone()
+    chunks = list(iter_denoise_chunked(model, audio, window, hop))
+    return torch.cat(chunks).reshape(audio.shape)
+
+
+def chunked_deviation(model: nn.Module, audio: Tensor,
+                      window: float = 10., hop: float = 9.) -> float:
+    """
+    Largest absolute difference between chunked and whole-file inference on
+    `audio`, relative to the RMS of the whole-file output.
+    """
+    with torch.no_grad():
+        whole = model(audio.reshape(1, 1, -1)).reshape(-1)
+    chunked = denoise_chunked(model, audio.reshape(-1), window, hop)
+    rms = whole.pow(2).mean().sqrt().clamp(min=1e-8)
+    return ((chunked - whole).abs().max() / rms).item()
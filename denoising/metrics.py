@@ -0,0 +1,48 @@
+"""
+Objective speech quality metrics: PESQ (wide band), STOI and SI-SNR.
+
+PESQ and STOI come from the optional `pesq` and `pystoi` packages, the same
+ones torchmetrics wraps, imported on first use.
+"""
+import math
+
+import numpy as np
+
+from typing import Dict
+
+
+def si_snr(estimate: np.ndarray, reference: np.ndarray, eps: float = 1e-8) -> float:
+    """Scale invariant signal to noise ratio in dB."""
+    estimate = estimate - estimate.mean()
+    reference = reference - reference.mean()
+    target = (estimate @ reference) / (reference @ reference + eps) * reference
+    noise = estimate - target
+    return 10 * math.log10((target @ target + eps) / (noise @ noise + eps))
+
+
+def pesq(estimate: np.ndarray, reference: np.ndarray, sample_rate: int = 16000) -> float:
+    from pesq import pesq as wb_pesq
+    from pesq import NoUtterancesError
+    try:
+        return float(wb_pesq(sample_rate, reference, estimate, 'wb'))
+    except NoUtterancesError:
+        return math.nan
+
+
+def stoi(estimate: np.ndarray, reference: np.ndarray, sample_rate: int = 16000) -> float:
+    from pystoi import stoi as compute_stoi
+    return float(compute_stoi(reference, estimate, sample_rate, extended=False))
+
+
+def score(estimate, reference, sample_rate: int = 16000) -> Dict[str, float]:
+    """
+    All three metrics for one mono clip. Inputs can be tensors or arrays of
+    any shape holding a single channel.
+    """
+    estimate = np.asarray(estimate, dtype=np.float64).reshape(-1)
+    reference = np.asarray(reference, dtype=np.float64).reshape(-1)
+    length = min(len(estimate), len(reference))
+    estimate, reference = estimate[:length], reference[:length]
+    return dict(pesq=pesq(estimate, reference, sample_rate),
+                stoi=stoi(estimate, reference, sample_rate),
+                snr=si_snr(estimate, reference))
@@ -0,0 +1,138 @@
+"""
+Reduced precision (bfloat16 / float16) CPU inference for `Demucs`, with a
+quality gate against the float model.
+
+Only the encoder and decoder convolutions run in reduced precision. The
+normalization, the resampling filters and the LSTM (whose recurrence would
+accumulate rounding error over every time step) stay in float32, and the
+output is rescaled in float32. No calibration is needed, unlike the int8
+variants.
+"""
+import copy
+
+import numpy as np
+import torch
+from torch import nn, Tensor
+
+from typing import Dict, Iterable, Optional, Tuple
+
+from . import metrics
+from .demucs import Demucs, masked_std
+
+DTYPES = dict(bfloat16=torch.bfloat16, float16=torch.float16)
+
+
+def is_supported(dtype: torch.dtype = torch.bfloat16) -> bool:
+    """Whether this CPU has native kernels for `dtype` (AVX512-BF16/AMX or AVX512-FP16 through oneDNN)."""
+    if not torch.backends.mkldnn.is_available():
+        return False
+    name = {torch.bfloat16: "_is_mkldnn_bf16_supported", torch.float16: "_is_mkldnn_fp16_supported"}[dtype]
+    check = getattr(torch.ops.mkldnn, name, None)
+    return bool(check()) if check is not None else False
+
+
+class ReducedPrecisionDemucs(nn.Module):
+    """
+    Copy of a float `Demucs` whose encoder and decoder run in `dtype`.
+    Args:
+        - model (Demucs): the float model, left untouched.
+        - dtype (torch.dtype): torch.bfloat16 or torch.float16.
+    """
+    def __init__(self, model: Demucs, dtype: torch.dtype = torch.bfloat16):
+        super().__init__()
+        self.model = copy.deepcopy(model).eval()
+        self.model.encoder.to(dtype)
+        self.model.decoder.to(dtype)
+        self.dtype = dtype
+        self.sample_rate = model.sample_rate
+        self.total_stride = model.total_stride
+
+    def valid_length(self, length: int) -> int:
+        return self.model.valid_length(length)
+
+    def forward(self, mix: Tensor, lengths: Optional[Tensor] = None) -> Tensor:
+        model = self.model
+        if mix.dim() == 2:
+            mix = mix.unsqueeze(1)
+        mix = mix.float()
+
+        if model.normalize:
+            mono = mix.mean(dim=1, keepdim=True)
+            if lengths is None:
+                std = mono.std(dim=-1, keepdim=True)
+            else:
+                std = masked_std(mono, lengths)
+            mix = mix / (model.floor + std)
+        else:
+            std = torch.ones(1)
+        length = mix.shape[-1]
+        x = nn.functional.pad(mix, (0, model.valid_length(length) - length))
+        x = model.upsample(x).to(self.dtype)
+
+        skips = []
+        for encode in model.encoder:
+            x = encode(x)
+            skips.append(x)
+        x, _ = model.lstm(x.permute(2, 0, 1).float())
+        x = x.permute(1, 2, 0).to(self.dtype)
+        for decode in model.decoder:
+            skip = skips.pop(-1)
+            x = x + skip[..., :x.shape[-1]]
+            x = decode(x)
+        x = model.downsample(x.float())
+        x = x[..., :length]
+        return std * x
+
+
+class QualityGateError(ValueError):
+    pass
+
+
+def quality_report(reference: nn.Module, candidate: nn.Module,
+                   pairs: Iterable[Tuple[Tensor, Tensor]]) -> Dict[str, float]:
+    """
+    Mean PESQ and SI-SNR of both models on (noisy, clean) pairs, each of
+    shape [1, T], plus the SI-SNR of the candidate against the reference
+    output (how closely it follows the float model).
+    """
+    scores = dict(reference_pesq=[], candidate_pesq=[], reference_snr=[], candidate_snr=[], agreement_snr=[])
+    with torch.no_grad():
+        for noisy, clean in pairs:
+            expected = reference(noisy.view(1, 1, -1)).reshape(-1)
+            actual = candidate(noisy.view(1, 1, -1)).reshape(-1)
+            clean = clean.reshape(-1)
+            for name, estimate in (("reference", expected), ("candidate", actual)):
+                scores[f"{name}_pesq"].append(metrics.pesq(estimate.double().numpy(), clean.double().numpy(),
+                                                           reference.sample_rate))
+                scores[f"{name}_snr"].append(metrics.si_snr(estimate.double().numpy(), clean.double().numpy()))
+            scores["agreement_snr"].append(metrics.si_snr(actual.double().numpy(), expected.double().numpy()))
+    if not scores["agreement_snr"]:
+        raise ValueError("the quality gate needs at least one reference pair")
+    return {name: float(np.nanmean(values)) for name, values in scores.items()}
+
+
+def reduced_precision(model: Demucs, pairs: Iterable[Tuple[Tensor, Tensor]],
+                      dtype: torch.dtype = torch.bfloat16, max_pesq_drop: float = 0.05,
+                      max_snr_drop: float = 0.2, require_native: bool = True) -> ReducedPrecisionDemucs:
+    """
+    Build the `dtype` version of `model` and accept it only if, on `pairs`,
+    its mean PESQ and SI-SNR (dB) are at most `max_pesq_drop` and
+    `max_snr_drop` below the float model's. Raises QualityGateError
+    otherwise, and ValueError when the CPU lacks native `dtype` kernels
+    (emulated kernels are slower than float32) unless `require_native` is off.
+    The accepted model carries its `quality_report` as `report`.
+    """
+    if not isinstance(model, Demucs):
+        raise ValueError("reduced precision needs a float Demucs, not a quantized variant")
+    if require_native and not is_supported(dtype):
+        raise ValueError(f"this CPU has no native {dtype} kernels")
+    model.eval()
+    candidate = ReducedPrecisionDemucs(model, dtype)
+    report = quality_report(model, candidate, pairs)
+    pesq_drop = report["reference_pesq"] - report["candidate_pesq"]
+    snr_drop = report["reference_snr"] - report["candidate_snr"]
+    if pesq_drop > max_pesq_drop or snr_drop > max_snr_drop:
+        raise QualityGateError(f"{dtype} loses {pesq_drop:.3f} PESQ and {snr_drop:.2f} dB SI-SNR, "
+                               f"over the limits of {max_pesq_drop} and {max_snr_drop}")
+    candidate.report = report
+    return candidate
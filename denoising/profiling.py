@@ -0,0 +1,139 @@
+"""
+Per-stage instrumentation for Demucs and QuantizedDemucs (eager mode only).
+
+    with LayerProfiler(model) as prof:
+        model(x)
+    print(prof.summary())
+    prof.to_chrome_trace("trace.json")  # open in chrome://tracing or Perfetto
+"""
+import json
+import time
+from collections import OrderedDict
+
+from torch import nn, Tensor
+
+from typing import Any, Dict, List, Optional
+
+QUANT_TYPES = ('QuantStub', 'DeQuantStub', 'Quantize', 'DeQuantize')
+
+
+def _nbytes(value) -> int:
+    if isinstance(value, Tensor):
+        return value.nelement() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+class LayerProfiler:
+    """
+    Records wall time and activation sizes for the two resample steps, each
+    encoder layer, the LSTM and each decoder layer, plus every quantize /
+    dequantize step (category "quant"), which are also counted inside the
+    stage that contains them. Hooks are installed on `__enter__` (or
+    `start`) and removed on `__exit__` (or `stop`).
+    """
+    def __init__(self, model: nn.Module):
+        self.model = model
+        self.events: List[Dict[str, Any]] = []
+        self._handles = []
+        self._starts: Dict[int, float] = {}
+        self._origin = 0.
+        self._call = -1
+
+    def stages(self) -> Dict[str, nn.Module]:
+        stages = OrderedDict()
+        stages['forward'] = self.model
+        stages['upsample'] = self.model.upsample
+        for index, encode in enumerate(self.model.encoder):
+            stages[f'encoder.{index}'] = encode
+        stages['lstm'] = self.model.lstm
+        for index, decode in enumerate(self.model.decoder):
+            stages[f'decoder.{index}'] = decode
+        stages['downsample'] = self.model.downsample
+        for name, module in self.model.named_modules():
+            if type(module).__name__ in QUANT_TYPES:
+                stages[name] = module
+        return stages
+
+    def _pre_hook(self, name: str):
+        def hook(module, inputs):
+            if name == 'forward':
+                self._call += 1
+            self._starts[id(module)] = time.perf_counter()
+        return hook
+
+    def _post_hook(self, name: str, category: str):
+        def hook(module, inputs, output):
+            end = time.perf_counter()
+            start = self._starts.pop(id(module))
+            self.events.append(dict(name=name, category=category, call=self._call,
+                                    start=start - self._origin, duration=end - start,
+                                    input_bytes=_nbytes(inputs), output_bytes=_nbytes(output)))
+        return hook
+
+    def start(self) -> 'LayerProfiler':
+        self._origin = time.perf_counter()
+        for name, module in self.stages().items():
+            if type(module).__name__ in QUANT_TYPES:
+                category = 'quant'
+            elif name in ('forward', 'lstm'):
+                category = name
+            else:
+                category = name.split('.')[0]
+            self._handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+            self._handles.append(module.register_forward_hook(self._post_hook(name, category)))
+        return self
+
+    def stop(self) -> None:
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def __enter__(self) -> 'LayerProfiler':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def reset(self) -> None:
+        self.events = []
+        self._call = -1
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Per stage totals over all recorded calls: number of calls, total and
+        mean wall time in milliseconds, and mean output size in bytes. The
+        "quant" entry sums every quantize / dequantize step.
+        """
+        totals: Dict[str, Dict[str, float]] = OrderedDict()
+
+        def add(name, event):
+            entry = totals.setdefault(name, dict(calls=0, total_ms=0., output_bytes=0.))
+            entry['calls'] += 1
+            entry['total_ms'] += event['duration'] * 1e3
+            entry['output_bytes'] += event['output_bytes']
+
+        for event in sorted(self.events, key=lambda e: e['start']):
+            add('quant' if event['category'] == 'quant' else event['name'], event)
+        for entry in totals.values():
+            entry['mean_ms'] = entry['total_ms'] / entry['calls']
+            entry['output_bytes'] /= entry['calls']
+        return totals
+
+    def to_json(self, path: Optional[str] = None) -> str:
+        data = json.dumps(dict(events=self.events, summary=self.summary()), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(data)
+        return data
+
+    def to_chrome_trace(self, path: str) -> None:
+        """Write the events in the Chrome trace event format."""
+        trace = [dict(name=e['name'], cat=e['category'], ph='X', pid=0, tid=0,
+                      ts=e['start'] * 1e6, dur=e['duration'] * 1e6,
+                      args=dict(call=e['call'], input_bytes=e['input_bytes'],
+                                output_bytes=e['output_bytes']))
+                 for e in self.events]
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=trace, displayTimeUnit='ms'), f)
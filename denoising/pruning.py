@@ -0,0 +1,283 @@
+"""
+Structured channel pruning of `Demucs`: whole channels are removed from the
+convolutions and LSTM, leaving a smaller dense model that is faster on every
+backend, the quantized and lite interpreter ones included.
+
+Stage i of a Demucs (encoder[i] and decoder[-i-1]) has three independent
+channel sets:
+    - hidden[i]: the output of the first encoder conv, consumed by the 1x1
+      conv feeding its GLU.
+    - skip[i]: the encoder output, which is also the skip connection, the
+      input of encoder[i + 1] (the LSTM for the last stage, whose units it
+      also sets), the decoder input and the output of the decoder above.
+      Pruning it removes the matching channel everywhere so shapes stay
+      consistent.
+    - glu[i]: the GLU output inside the decoder, feeding its transposed conv.
+
+Channels are ranked by the L1 norm of the weights producing and consuming
+them, and every set keeps the same fraction of its channels; `prune_to_budget`
+searches that fraction for a FLOP or latency budget. The resulting widths
+form a spec from which `pruned_demucs` rebuilds the model.
+"""
+import copy
+import statistics
+import time
+
+import torch
+from torch import nn, Tensor
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from .demucs import BLSTM, Demucs
+
+Spec = Dict[str, Any]
+
+
+def _kwargs(model: Demucs) -> Dict[str, Any]:
+    return dict(hidden=model.hidden, depth=model.depth, kernel_size=model.kernel_size, stride=model.stride,
+                causal=model.causal, resample=model.resample, normalize=model.normalize, floor=model.floor,
+                sample_rate=model.sample_rate)
+
+
+def widths(model: Demucs) -> Spec:
+    """Spec of `model`: its constructor arguments and the width of every channel set."""
+    depth = model.depth
+    return dict(kwargs=_kwargs(model),
+                hidden=[model.encoder[i][0].out_channels for i in range(depth)],
+                skip=[model.encoder[i][2].out_channels // 2 for i in range(depth)],
+                glu=[model.decoder[depth - 1 - i][0].out_channels // 2 for i in range(depth)])
+
+
+def pruned_demucs(spec: Spec) -> Demucs:
+    """Randomly initialized `Demucs` with the channel widths of `spec`."""
+    kwargs = spec["kwargs"]
+    model = Demucs(**kwargs)
+    depth, kernel_size, stride = model.depth, model.kernel_size, model.stride
+    for i in range(depth):
+        chin = spec["skip"][i - 1] if i > 0 else 1
+        encode = model.encoder[i]
+        encode[0] = nn.Conv1d(chin, spec["hidden"][i], kernel_size, stride)
+        encode[2] = nn.Conv1d(spec["hidden"][i], 2 * spec["skip"][i], 1)
+        decode = model.decoder[depth - 1 - i]
+        decode[0] = nn.Conv1d(spec["skip"][i], 2 * spec["glu"][i], 1)
+        decode[2] = nn.ConvTranspose1d(spec["glu"][i], chin, kernel_size, stride)
+    model.lstm = BLSTM(spec["skip"][-1], bi=not model.causal)
+    return model
+
+
+def _l1(weight: Tensor, dim: int) -> Tensor:
+    """L1 norm of every slice of `weight` along `dim`."""
+    return weight.abs().transpose(0, dim).reshape(weight.shape[dim], -1).sum(dim=1)
+
+
+def _glu_l1(weight: Tensor) -> Tensor:
+    """L1 norm of the weights producing each GLU output channel (both halves)."""
+    half = weight.shape[0] // 2
+    rows = _l1(weight, 0)
+    return rows[:half] + rows[half:]
+
+
+def _normalized(scores: Tensor) -> Tensor:
+    return scores / scores.mean().clamp(min=1e-12)
+
+
+def channel_scores(model: Demucs) -> Dict[str, List[Tensor]]:
+    """Importance of every channel, by channel set and stage (higher is kept first)."""
+    depth = model.depth
+    scores: Dict[str, List[Tensor]] = dict(hidden=[], skip=[], glu=[])
+    for i in range(depth):
+        encode, decode = model.encoder[i], model.decoder[depth - 1 - i]
+        scores["hidden"].append(_normalized(_l1(encode[0].weight, 0)) + _normalized(_l1(encode[2].weight, 1)))
+        scores["skip"].append(_normalized(_glu_l1(encode[2].weight)) + _normalized(_l1(decode[0].weight, 1)))
+        scores["glu"].append(_normalized(_glu_l1(decode[0].weight)) + _normalized(_l1(decode[2].weight, 0)))
+    return {key: [s.detach() for s in value] for key, value in scores.items()}
+
+
+def _keep(scores: Tensor, width: int) -> Tensor:
+    return scores.topk(width).indices.sort().values
+
+
+def _glu_rows(keep: Tensor, half: int) -> Tensor:
+    return torch.cat([keep, keep + half])
+
+
+def _lstm_state(lstm: nn.LSTM, keep: Tensor, prefix: str) -> Dict[str, Tensor]:
+    size = lstm.hidden_size
+    directions = 2 if lstm.bidirectional else 1
+    rows = torch.cat([gate * size + keep for gate in range(4)])
+    # layers past the first take the concatenated directions as input
+    layer_input = torch.cat([d * size + keep for d in range(directions)])
+    state = {}
+    for name, value in lstm.named_parameters():
+        layer = int(name.split("_l")[1][0])
+        value = value.detach()[rows]
+        if name.startswith("weight_ih"):
+            value = value[:, keep if layer == 0 else layer_input]
+        elif name.startswith("weight_hh"):
+            value = value[:, keep]
+        state[prefix + name] = value
+    return state
+
+
+def prune(model: Demucs, spec: Spec) -> Demucs:
+    """
+    Smaller copy of `model` with the widths of `spec` (see `widths`), keeping
+    the highest scoring channels of every set along with their weights.
+    """
+    depth = model.depth
+    scores = channel_scores(model)
+    keep = {key: [_keep(scores[key][i], spec[key][i]) for i in range(depth)] for key in scores}
+    state = {}
+
+    def slice_conv(name, conv, rows, cols, transposed=False):
+        weight = conv.weight.detach()
+        # transposed convs store [in, out, k]
+        weight = weight[cols][:, rows] if transposed else weight[rows][:, cols]
+        state[f"{name}.weight"] = weight
+        state[f"{name}.bias"] = conv.bias.detach()[rows]
+
+    for i in range(depth):
+        chin = keep["skip"][i - 1] if i > 0 else torch.tensor([0])
+        encode, decode = model.encoder[i], model.decoder[depth - 1 - i]
+        slice_conv(f"encoder.{i}.0", encode[0], keep["hidden"][i], chin)
+        slice_conv(f"encoder.{i}.2", encode[2], _glu_rows(keep["skip"][i], encode[2].out_channels // 2),
+                   keep["hidden"][i])
+        slice_conv(f"decoder.{depth - 1 - i}.0", decode[0], _glu_rows(keep["glu"][i], decode[0].out_channels // 2),
+                   keep["skip"][i])
+        slice_conv(f"decoder.{depth - 1 - i}.2", decode[2], chin, keep["glu"][i], transposed=True)
+
+    last = keep["skip"][-1]
+    state.update(_lstm_state(model.lstm.lstm, last, "lstm.lstm."))
+    if model.lstm.linear is not None:
+        size = model.lstm.lstm.hidden_size
+        state["lstm.linear.weight"] = model.lstm.linear.weight.detach()[last][:, torch.cat([last, size + last])]
+        state["lstm.linear.bias"] = model.lstm.linear.bias.detach()[last]
+
+    pruned = pruned_demucs(spec)
+    # the resampler kernels are not in the state dict (see `demucs.Resampler`), so the state is complete
+    pruned.load_state_dict({key: value.clone() for key, value in state.items()})
+    return pruned
+
+
+def scaled_spec(model: Demucs, ratio: float, multiple: int = 4) -> Spec:
+    """
+    Spec keeping `ratio` of the channels of every set, rounded to a multiple
+    of `multiple` (vector friendly for the mobile kernels), at least one
+    multiple and at most the current width.
+    """
+    spec = widths(model)
+    for key in ("hidden", "skip", "glu"):
+        spec[key] = [min(width, max(multiple, round(width * ratio / multiple) * multiple))
+                     for width in spec[key]]
+    return spec
+
+
+def count_flops(model: nn.Module, seconds: float = 1.) -> int:
+    """
+    Floating point operations (two per multiply-accumulate) of the
+    convolutions, LSTM and linear layers when denoising `seconds` of audio.
+    """
+    macs = 0
+
+    def conv_hook(module, inputs, output):
+        nonlocal macs
+        kernel = module.kernel_size[0] * module.in_channels * module.out_channels // module.groups
+        # a transposed conv spends its kernel on every input step, a conv on every output step
+        steps = inputs[0].shape[-1] if isinstance(module, nn.ConvTranspose1d) else output.shape[-1]
+        macs += output.shape[0] * steps * kernel
+
+    def lstm_hook(module, inputs, output):
+        nonlocal macs
+        steps, batch = inputs[0].shape[:2]
+        directions = 2 if module.bidirectional else 1
+        size = module.hidden_size
+        for layer in range(module.num_layers):
+            input_size = module.input_size if layer == 0 else directions * size
+            macs += steps * batch * directions * 4 * size * (input_size + size)
+
+    def linear_hook(module, inputs, output):
+        nonlocal macs
+        macs += output.numel() // module.out_features * module.in_features * module.out_features
+
+    hooks = []
+    for module in model.modules():
+        if isinstance(module, (nn.Conv1d, nn.ConvTranspose1d)):
+            hooks.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.LSTM):
+            hooks.append(module.register_forward_hook(lstm_hook))
+        elif isinstance(module, nn.Linear):
+            hooks.append(module.register_forward_hook(linear_hook))
+    try:
+        with torch.no_grad():
+            model(torch.zeros(1, 1, int(seconds * model.sample_rate)))
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return 2 * macs
+
+
+def measure_latency(model: nn.Module, seconds: float = 1., trials: int = 10, warmup: int = 2) -> float:
+    """Median wall time in seconds of denoising `seconds` of audio."""
+    x = torch.randn(1, 1, int(seconds * model.sample_rate))
+    times = []
+    with torch.no_grad():
+        for trial in range(warmup + trials):
+            start = time.perf_counter()
+            model(x)
+            if trial >= warmup:
+                times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def prune_to_budget(model: Demucs, flops: Optional[float] = None, latency: Optional[float] = None,
+                    seconds: float = 1., multiple: int = 4, steps: int = 8) -> Tuple[Demucs, Spec]:
+    """
+    Prune `model` as little as possible while meeting a budget, either
+    `flops` or `latency` (seconds, measured here) for `seconds` of audio.
+    Bisects the fraction of channels kept; returns the pruned model and its
+    spec. Raises ValueError if even the smallest model misses the budget.
+    """
+    if (flops is None) == (latency is None):
+        raise ValueError("give exactly one of flops or latency")
+    model.eval()
+
+    def cost(candidate):
+        if flops is not None:
+            return count_flops(candidate, seconds), flops
+        return measure_latency(candidate, seconds), latency
+
+    def build(ratio):
+        spec = scaled_spec(model, ratio, multiple)
+        return prune(model, spec), spec
+
+    value, budget = cost(model)
+    if value <= budget:
+        # a copy, like every other path, so the caller can train it without touching `model`
+        return copy.deepcopy(model), widths(model)
+    best = build(0.)
+    value, budget = cost(best[0])
+    if value > budget:
+        raise ValueError(f"the smallest pruned model still costs {value:.4g}, over the budget of {budget:.4g}")
+
+    low, high = 0., 1.
+    for _ in range(steps):
+        ratio = (low + high) / 2
+        candidate = build(ratio)
+        value, budget = cost(candidate[0])
+        if value <= budget:
+            best, low = candidate, ratio
+        else:
+            high = ratio
+    return best
+
+
+def save_pruned(model: Demucs, spec: Spec, path: str):
+    torch.save(dict(spec=spec, state=model.state_dict()), path)
+
+
+def load_pruned(path: str) -> Demucs:
+    """Rebuild a model saved by `save_pruned`."""
+    checkpoint = torch.load(path, map_location="cpu", weights_only=True)
+    model = pruned_demucs(checkpoint["spec"])
+    model.load_state_dict(checkpoint["state"])
+    return model
@@ -0,0 +1,67 @@
+"""
+Quantization aware training of `QuantizedDemucs`.
+
+Instead of calibrating a converted copy of the float weights (see
+`prepare_and_convert`), the model is fine-tuned with fake quantization in
+the loop, so the weights adapt to int8 rounding before conversion. Conv1d
+layers (fused with their ReLU in the encoder) train with fake quantized
+weights and activations. Transposed convs have no QAT module in eager mode,
+so only their input and output ranges are learned; their weights are
+quantized at conversion. The static LSTM learns its activation ranges the
+same way.
+"""
+import torch
+from torch import nn
+from torch.ao.nn import intrinsic as nni, qat as nnqat, quantized as nnq
+from torch.ao.nn.intrinsic import qat as nniqat, quantized as nniq
+from torch.ao.quantization import (convert, disable_observer, get_default_qat_module_mappings,
+                                   get_default_static_quant_module_mappings, prepare_qat)
+
+from typing import Dict, Iterable
+
+from . import registry, training
+from .demucs import load_pretrained_demucs
+from .quantized_demucs import QuantizedDemucs, fuse_conv_relu, load_model_state_to_quantized, use_per_channel_weights
+
+# the default eager mappings stop at 2d convs, our layers are 1d
+QAT_MAPPINGS = {**get_default_qat_module_mappings(),
+                nn.Conv1d: nnqat.Conv1d,
+                nni.ConvReLU1d: nniqat.ConvReLU1d}
+CONVERT_MAPPINGS = {**get_default_static_quant_module_mappings(),
+                    nnqat.Conv1d: nnq.Conv1d,
+                    nniqat.ConvReLU1d: nniq.ConvReLU1d}
+
+
+def prepare(name: str, quantize_opts: Dict[str, bool], per_channel: bool = False,
+            engine: str = "qnnpack") -> QuantizedDemucs:
+    """`QuantizedDemucs` with the pretrained `name` weights, fused and prepared for QAT."""
+    torch.backends.quantized.engine = engine
+    model = QuantizedDemucs(**{"sample_rate": 16000, **registry.model_kwargs(name)}, quantize_opts=quantize_opts)
+    load_model_state_to_quantized(load_pretrained_demucs(name), model)
+    model.train()
+    fuse_conv_relu(model)
+    if per_channel:
+        use_per_channel_weights(model)
+    return prepare_qat(model, mapping=QAT_MAPPINGS)
+
+
+def train(model: QuantizedDemucs, batches: Iterable[training.Batch], steps: int, lr: float = 1e-5,
+          freeze_observers: float = 0.5) -> QuantizedDemucs:
+    """
+    Fine-tune a prepared model for `steps` steps. After `freeze_observers` of
+    them the quantization ranges are frozen, so the last steps train the
+    weights against the grid they will be converted with.
+    """
+    frozen_after = int(steps * freeze_observers)
+    if frozen_after:
+        training.finetune(model, batches, frozen_after, lr)
+    model.apply(disable_observer)
+    if steps - frozen_after:
+        training.finetune(model, batches, steps - frozen_after, lr)
+    return model
+
+
+def convert_trained(model: QuantizedDemucs) -> QuantizedDemucs:
+    """The int8 model of a trained QAT model."""
+    model.eval()
+    return convert(model, mapping=CONVERT_MAPPINGS)
@@ -4,16 +4,21 @@ definition so we can easily load in pretrained models, if needed.
 """
 import torch
 from torch.quantization import QuantStub, DeQuantStub, get_default_qat_qconfig, quantize_dynamic
-from torch import hub
+from torch.ao.quantization import QConfig, default_per_channel_weight_fake_quant, fuse_modules
+from torch.ao.nn.intrinsic import ConvReLU1d
+from torch import hub, Tensor
 from torch import nn
 from torch.nn import functional as F
 from torch.utils.data import DataLoader
-from torchaudio.functional import resample
 
-from typing import Dict
+from typing import Dict, Optional
+import hashlib
+import json
 import math
+import os
 
-from .demucs import BLSTM, Demucs, load_pretrained_demucs
+from . import registry
+from .demucs import BLSTM, Demucs, load_pretrained_demucs, masked_std, resampler
 
 
 class QuantizedDemucs(nn.Module):
@@ -48,6 +53,8 @@ class QuantizedDemucs(nn.Module):
         self.resample = resample
         self.normalize = normalize
         self.sample_rate = sample_rate
+        self.upsample = resampler(sample_rate, sample_rate * resample)
+        self.downsample = resampler(sample_rate * resample, sample_rate)
 
         self.encoder = nn.ModuleList()
         self.decoder = nn.ModuleList()
@@ -56,7 +63,7 @@ class QuantizedDemucs(nn.Module):
         
         # Quantization code
         self.qconfig = get_default_qat_qconfig('qnnpack')
-        self.quantize_opts = quantize_opts
+        self.quantize_opts = {'encoder': False, 'lstm': False, 'decoder': False, **quantize_opts}
 
         self.quant = QuantStub(qconfig=self.qconfig)
         self.dequant = DeQuantStub(qconfig=self.qconfig)
@@ -85,6 +92,13 @@ class QuantizedDemucs(nn.Module):
             ]
             if index > 0:
                 decode.append(nn.ReLU())
+            if self.quantize_opts['decoder']:
+                # Same GLU workaround as the encoder. The ReLU stays in float
+                # after the transposed conv, so streaming can still overlap-add
+                # its output before the activation.
+                decode = [QuantStub(qconfig=self.qconfig), decode[0], DeQuantStub(qconfig=self.qconfig),
+                          activation,
+                          QuantStub(qconfig=self.qconfig), decode[2], DeQuantStub(qconfig=self.qconfig)] + decode[3:]
             self.decoder.insert(0, nn.Sequential(*decode))
             chout = hidden
             chin = hidden
@@ -95,11 +109,13 @@ class QuantizedDemucs(nn.Module):
         if not self.quantize_opts['encoder']:
             for encoder in self.encoder:
                 encoder.qconfig = None
-        # TODO: add option to statically quantize decoder?
-        for decoder in self.decoder:
-            decoder.qconfig = None
+        if not self.quantize_opts['decoder']:
+            for decoder in self.decoder:
+                decoder.qconfig = None
         if not self.quantize_opts['lstm']:
             self.lstm.qconfig = None
+        self.upsample.qconfig = None
+        self.downsample.qconfig = None
 
         # if rescale:
         #     rescale_module(self, reference=rescale)
@@ -126,23 +142,23 @@ class QuantizedDemucs(nn.Module):
     def total_stride(self):
         return self.stride ** self.depth // self.resample
 
-    def forward(self, mix):
+    def forward(self, mix, lengths: Optional[Tensor] = None):
         if mix.dim() == 2:
             mix = mix.unsqueeze(1)
 
         if self.normalize:
             mono = mix.mean(dim=1, keepdim=True)
-            std = mono.std(dim=-1, keepdim=True)
+            if lengths is None:
+                std = mono.std(dim=-1, keepdim=True)
+            else:
+                std = masked_std(mono, lengths)
             mix = mix / (self.floor + std)
         else:
             std = torch.tensor([1])
         length = mix.shape[-1]
         x = mix
         x = F.pad(x, (0, self.valid_length(length) - length))
-        if self.resample == 2:
-          x = resample(x, self.sample_rate, self.sample_rate * 2)
-        elif self.resample == 4:
-          x = resample(x, self.sample_rate, self.sample_rate * 4)
+        x = self.upsample(x)
 
         skips = []
         for encode in self.encoder:
@@ -159,18 +175,27 @@ class QuantizedDemucs(nn.Module):
         x = x.permute(1, 2, 0)
         for decode in self.decoder:
             skip = skips.pop(-1)
+            # Both operands are float (the encoder ends on GLU), so the skip
+            # add stays in float and the sum is quantized once by the decoder.
             x = x + skip[..., :x.shape[-1]]
             x = decode(x)
-        if self.resample == 2:
-          x = resample(x, self.sample_rate *2, self.sample_rate)
-        elif self.resample == 4:
-          x = resample(x, self.sample_rate *4, self.sample_rate)
+        x = self.downsample(x)
         x = x[..., :length]
         return std * x
     @classmethod
     def from_facebook_pretrained(cls, name: str, quantize_opts: Dict[str, bool],
                                  dynamic: None | torch.dtype = None,
-                                 sample_audio: torch.Tensor | DataLoader | None = None):
+                                 sample_audio: torch.Tensor | DataLoader | None = None,
+                                 per_channel: bool = False,
+                                 engine: str = 'qnnpack',
+                                 calibration_cache: Optional[str] = None):
+        """
+        Build a quantized variant of a pretrained model. When
+        `calibration_cache` is a directory, the calibrated observer statistics
+        are stored there, keyed by the model name, `quantize_opts`, engine and
+        a hash of the calibration data, and reused by later conversions
+        instead of running the calibration forward passes again.
+        """
         static = any(quantize_opts.values())
         pretrained = load_pretrained_demucs(name)
         if not static:
@@ -179,15 +204,23 @@ class QuantizedDemucs(nn.Module):
             return quantize_dynamic(pretrained,
                                     qconfig_spec={nn.LSTM},
                                     dtype=dynamic)
-        hidden = 48 if name == 'dns48' else 64
-        quantized = cls(hidden=hidden,
-                                              quantize_opts=quantize_opts
-                                          ) 
+        quantized = cls(**{'sample_rate': 16000, **registry.model_kwargs(name)},
+                        quantize_opts=quantize_opts)
         load_model_state_to_quantized(pretrained, quantized)
 
         
         if static and sample_audio is not None:
-            quantized = prepare_and_convert(quantized, sample_audio)
+            cache_path = None
+            if calibration_cache is not None:
+                if not isinstance(sample_audio, torch.Tensor) and iter(sample_audio) is sample_audio:
+                    # a one-shot iterator cannot be read for the key and again for calibration
+                    sample_audio = list(sample_audio)
+                key = calibration_key(name, quantize_opts, engine, per_channel, sample_audio)
+                cache_path = os.path.join(calibration_cache, f'{name}-{key}.pt')
+            quantized = prepare_and_convert(quantized, sample_audio,
+                                            engine=engine,
+                                            per_channel=per_channel,
+                                            cache_path=cache_path)
         else:
             if static: 
                 raise ValueError('static quantization passed but no sample audio')
@@ -209,6 +242,8 @@ def load_model_state_to_quantized(src: Demucs, dst: QuantizedDemucs) -> None:
         for x, y in zip(dst_conv, src_conv):
             x.load_state_dict(y.state_dict())
 
+    # quant stubs are skipped by the filters, so the float and quantized
+    # layouts line up conv for conv
     for i, (se, de) in enumerate(zip(src.decoder, dst.decoder)):
         dst_conv = filter(lambda x: isinstance(x,nn.Conv1d) or isinstance(x,nn.ConvTranspose1d), de)
         src_conv = filter(lambda x: isinstance(x,nn.Conv1d) or isinstance(x,nn.ConvTranspose1d), se)
@@ -218,19 +253,123 @@ def load_model_state_to_quantized(src: Demucs, dst: QuantizedDemucs) -> None:
 
     dst.lstm.load_state_dict(src.lstm.state_dict())
 
+def _static_blocks(model: QuantizedDemucs):
+    # blocks left in float have their qconfig set to None in __init__
+    for block in list(model.encoder) + list(model.decoder):
+        if getattr(block, 'qconfig', model.qconfig) is not None:
+            yield block
+
+def fuse_conv_relu(model: QuantizedDemucs) -> None:
+    """
+    Fuse every Conv1d -> ReLU pair of the statically quantized blocks in
+    place, so each pair runs as a single quantized kernel. Transposed convs
+    cannot be fused in eager mode, so in practice this only touches the
+    encoder.
+    """
+    for block in _static_blocks(model):
+        pairs = [[str(i), str(i + 1)] for i in range(len(block) - 1)
+                 if isinstance(block[i], nn.Conv1d) and isinstance(block[i + 1], nn.ReLU)]
+        if pairs:
+            fuse_modules(block, pairs, inplace=True)
+
+def use_per_channel_weights(model: QuantizedDemucs) -> None:
+    """
+    Switch the weight observers of the statically quantized Conv1d layers
+    (fused or not) to per-channel. Transposed convs and the LSTM keep the
+    per-tensor default, since eager mode does not support per-channel
+    weights for them.
+    """
+    qconfig = QConfig(activation=model.qconfig.activation,
+                      weight=default_per_channel_weight_fake_quant)
+    for block in _static_blocks(model):
+        for layer in block:
+            if isinstance(layer, (nn.Conv1d, ConvReLU1d)):
+                layer.qconfig = qconfig
+
+def calibration_data_hash(data) -> str:
+    """
+    Hash of calibration audio, given as a tensor or an iterable (e.g. a
+    DataLoader) of (x, _) or (x, _, lengths) batches. Batches are hashed as
+    they are read, never all held at once. A DataLoader over an indexed
+    dataset (see `data.valentini.dataset.IndexedPairsDataset`) is hashed by
+    the index and the batches its sampler draws, without reading any audio.
+    """
+    data_hash = hashlib.sha256()
+    dataset = getattr(data, 'dataset', None)
+    if isinstance(getattr(dataset, 'index', None), dict) and getattr(data, 'batch_sampler', None) is not None:
+        # the index holds the source files and where every clip lives in the store
+        data_hash.update(json.dumps(dataset.index, sort_keys=True).encode())
+        data_hash.update(json.dumps([list(map(int, batch)) for batch in data.batch_sampler]).encode())
+        return data_hash.hexdigest()
+    batches = [data] if isinstance(data, torch.Tensor) else (batch[0] for batch in data)
+    for x in batches:
+        data_hash.update(str(tuple(x.shape)).encode())
+        data_hash.update(x.detach().cpu().contiguous().numpy().tobytes())
+    return data_hash.hexdigest()
+
+def calibration_key(name: str, quantize_opts: Dict[str, bool], engine: str,
+                    per_channel: bool, data) -> str:
+    """
+    Hash identifying a calibration run: the model and its checkpoint (whose
+    file name carries a hash of the weights, so re-registering a name with
+    new weights gets a new key), the quantization options and the
+    calibration audio.
+    """
+    key = json.dumps(dict(name=name,
+                          checkpoint=registry.entries()[name]['file'],
+                          quantize_opts=sorted({'encoder': False, 'lstm': False, 'decoder': False,
+                                                **quantize_opts}.items()),
+                          engine=engine,
+                          per_channel=per_channel,
+                          torch=torch.__version__,
+                          data=calibration_data_hash(data)))
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+def _observer_state(prepared: nn.Module) -> Dict[str, torch.Tensor]:
+    return {k: v for k, v in prepared.state_dict().items() if 'activation_post_process' in k}
+
 def prepare_and_convert(model: QuantizedDemucs, 
                         data: DataLoader | torch.Tensor, 
-                        engine: str = 'qnnpack') -> QuantizedDemucs:
+                        engine: str = 'qnnpack',
+                        per_channel: bool = False,
+                        cache_path: Optional[str] = None) -> QuantizedDemucs:
+    """
+    Calibrate and convert a statically quantized model. If `cache_path`
+    exists, the activation observer statistics are loaded from it instead of
+    running `data` through the model; otherwise they are saved there after
+    calibration.
+    """
     torch.backends.quantized.engine = engine
+    fuse_conv_relu(model)
+    if per_channel:
+        use_per_channel_weights(model)
     prepared = torch.ao.quantization.prepare(model)
     prepared.eval()
 
-    if isinstance(data, torch.Tensor):
-        prepared(data)
+    cached = None
+    if cache_path is not None and os.path.exists(cache_path):
+        cached = torch.load(cache_path)
+        # a cache from a different layout would leave observers uncalibrated
+        if set(cached) != set(_observer_state(prepared)):
+            cached = None
+    if cached is not None:
+        # the keys were checked above, the weights are the model's own
+        prepared.load_state_dict(cached, strict=False)
     else:
-        for x, _ in data:
-            prepared(x)
-    
+        with torch.no_grad():
+            if isinstance(data, torch.Tensor):
+                prepared(data)
+            else:
+                for batch in data:
+                    # padded batches (see collate_padded) carry their lengths last
+                    lengths = batch[2] if len(batch) > 2 else None
+                    prepared(batch[0], lengths)
+        if cache_path is not None:
+            os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+            # parallel exports may calibrate the same key, so never expose a partial file
+            torch.save(_observer_state(prepared), f'{cache_path}.{os.getpid()}.tmp')
+            os.replace(f'{cache_path}.{os.getpid()}.tmp', cache_path)
+
     converted = torch.ao.quantization.convert(prepared)
 
     return converted
@@ -0,0 +1,183 @@
+"""
+Local registry of pretrained checkpoints.
+
+Names resolve to a checkpoint file in `model_dir()` plus the constructor
+kwargs it was trained with. The built-in facebookresearch/denoiser models are
+downloaded on first use (unless `DENOISER_OFFLINE` is set), and extra entries
+can be added with a `registry.json` file in the model directory:
+
+    {"my_model": {"file": "my_model.th", "kwargs": {"hidden": 32}}}
+"""
+import fcntl
+import hashlib
+import json
+import os
+import re
+
+import torch
+from torch import hub
+
+from typing import Any, Dict, Tuple
+
+ROOT = "https://dl.fbaipublicfiles.com/adiyoss/denoiser/"
+PRETRAINED = {
+    'dns48': dict(file="dns48-11decc9d8e3f0998.th", kwargs=dict(hidden=48)),
+    'dns64': dict(file="dns64-a7761ff99a7d5bb6.th", kwargs=dict(hidden=64)),
+    'master64': dict(file="master64-8a5dfb4bb92753dd.th", kwargs=dict(hidden=64)),
+    'valentini': dict(file="valentini_nc-93fc4337.th",  # Non causal
+                      kwargs=dict(hidden=64, causal=False, stride=2, resample=2)),
+}
+
+# same convention as torch.hub: the file name ends in a sha256 prefix
+HASH_REGEX = re.compile(r'-([a-f0-9]+)\.')
+
+
+def model_dir() -> str:
+    """
+    Directory holding the checkpoints, `DENOISER_MODEL_DIR` if set. Defaults
+    to the torch.hub checkpoint directory, so previously downloaded models
+    are picked up.
+    """
+    return os.environ.get('DENOISER_MODEL_DIR', os.path.join(hub.get_dir(), 'checkpoints'))
+
+
+def entries() -> Dict[str, Dict[str, Any]]:
+    registry = dict(PRETRAINED)
+    local = os.path.join(model_dir(), 'registry.json')
+    if os.path.exists(local):
+        with open(local) as f:
+            registry.update(json.load(f))
+    return registry
+
+
+def model_kwargs(name: str) -> Dict[str, Any]:
+    """Constructor kwargs stored for `name`."""
+    registry = entries()
+    if name not in registry:
+        raise ValueError(f'pretrained name needs to be in {list(registry.keys())}')
+    return dict(registry[name].get('kwargs', {}))
+
+
+def resolve(name: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    Return the verified on-disk checkpoint path for `name` and its constructor
+    kwargs, downloading built-in models that are missing unless
+    `DENOISER_OFFLINE` is set.
+    """
+    kwargs = model_kwargs(name)
+    filename = entries()[name]['file']
+    path = os.path.join(model_dir(), filename)
+    if not os.path.exists(path):
+        if name not in PRETRAINED or os.environ.get('DENOISER_OFFLINE'):
+            raise FileNotFoundError(f'checkpoint for {name} not found at {path}')
+        os.makedirs(model_dir(), exist_ok=True)
+        match = HASH_REGEX.search(filename)
+        hub.download_url_to_file(ROOT + filename, path,
+                                 hash_prefix=match.group(1) if match else None)
+    verify(path)
+    return path, kwargs
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def verify(path: str) -> None:
+    """
+    Check the file against the hash prefix in its name. The result is
+    remembered in a `.verified` file next to it, keyed by size and mtime, so
+    unchanged checkpoints are only hashed once.
+    """
+    match = HASH_REGEX.search(os.path.basename(path))
+    if match is None:
+        return
+    stat = os.stat(path)
+    stamp = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    marker = path + '.verified'
+    try:
+        with open(marker) as f:
+            if json.load(f) == stamp:
+                return
+    except (OSError, ValueError):
+        pass
+
+    digest = _sha256(path)
+    if not digest.startswith(match.group(1)):
+        raise RuntimeError(f'invalid hash value for {path}: expected {match.group(1)}, got {digest}')
+    _save_best_effort(marker, lambda tmp: _dump_json(stamp, tmp))
+
+
+def _dump_json(value: Any, path: str) -> None:
+    with open(path, 'w') as f:
+        json.dump(value, f)
+
+
+def _save_best_effort(path: str, save) -> bool:
+    """
+    Write `path` through `save(tmp)` and an atomic rename, so processes racing
+    on the same file never see a partial one. Returns False instead of
+    raising when the directory is not writable (e.g. a read-only model mount).
+    """
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        save(tmp)
+        os.replace(tmp, path)
+        return True
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+
+
+def load_state_dict(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Load a checkpoint memory-mapped, so worker processes loading the same
+    model share its pages. Checkpoints in the legacy (non zip) format cannot
+    be mapped; they are converted once to a `.mmap` copy next to them, or
+    loaded into memory when that copy cannot be written.
+    """
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except RuntimeError:
+        pass
+    converted = path + '.mmap'
+    if not os.path.exists(converted) or os.path.getmtime(converted) < os.path.getmtime(path):
+        state = torch.load(path, map_location='cpu', weights_only=True)
+        if not _save_best_effort(converted, lambda tmp: torch.save(state, tmp)):
+            return state
+    return torch.load(converted, map_location='cpu', mmap=True, weights_only=True)
+
+
+def register(name: str, state: Dict[str, torch.Tensor], kwargs: Dict[str, Any]) -> str:
+    """
+    Save a trained model's state dict to `model_dir()` under a hash-suffixed
+    file name and add it to `registry.json`, so `name` resolves like the
+    built-in models. Returns the checkpoint path.
+    """
+    if name in PRETRAINED:
+        raise ValueError(f'{name} is a built-in model')
+    directory = model_dir()
+    os.makedirs(directory, exist_ok=True)
+    tmp = os.path.join(directory, f'{name}.th.{os.getpid()}.tmp')
+    torch.save(state, tmp)
+    filename = f'{name}-{_sha256(tmp)[:16]}.th'
+    os.replace(tmp, os.path.join(directory, filename))
+
+    local = os.path.join(directory, 'registry.json')
+    # held across the read-modify-write, so concurrent registrations do not drop each other's entry
+    with open(local + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        registry = {}
+        if os.path.exists(local):
+            with open(local) as f:
+                registry = json.load(f)
+        registry[name] = dict(file=filename, kwargs=kwargs)
+        tmp = f'{local}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(registry, f, indent=2)
+        os.replace(tmp, local)
+    return os.path.join(directory, filename)
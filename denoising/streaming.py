@@ -0,0 +1,232 @@
+"""
+Streaming inference for the causal Demucs configurations (dns48, dns64,
+master64), adapted from the DemucsStreamer in facebookresearch/denoiser.
+
+Instead of renormalizing and rerunning the whole clip, the streamer keeps the
+per-layer convolution context and the LSTM hidden state between calls, so the
+cost of every new frame is constant.
+"""
+import math
+import time
+
+import torch
+from torch import nn, Tensor
+
+from typing import List, Optional, Tuple
+
+
+def _split_decode(decode: nn.Sequential) -> Tuple[nn.Module, nn.Module, nn.Module, Tensor]:
+    """
+    Split a decoder block into the layers before the transposed convolution,
+    the transposed convolution itself (with its quantize / dequantize pair
+    when the decoder is statically quantized), the trailing activation, and
+    the transposed convolution bias.
+    """
+    for index, layer in enumerate(decode):
+        if type(layer).__name__ == 'ConvTranspose1d':
+            start, end = index, index + 1
+            if start > 0 and type(decode[start - 1]).__name__ in ('QuantStub', 'Quantize'):
+                start -= 1
+            if end < len(decode) and type(decode[end]).__name__ in ('DeQuantStub', 'DeQuantize'):
+                end += 1
+            # quantized convolutions expose their bias through a method
+            bias = layer.bias() if callable(layer.bias) else layer.bias
+            return decode[:start], decode[start:end], decode[end:], bias
+    raise ValueError("decoder block has no ConvTranspose1d layer")
+
+
+class DemucsStreamer:
+    """
+    Streaming wrapper around a causal `Demucs` or `QuantizedDemucs`.
+    Args:
+        - demucs: causal model to stream through.
+        - dry (float): amount of dry (noisy) signal mixed into the output.
+        - num_frames (int): number of `total_stride` frames processed per step.
+        - resample_lookahead (int): extra input samples used to pad the
+            upsampling on the right.
+        - resample_buffer (int): past input samples kept to pad the
+            resampling on the left.
+
+    Audio is pushed with `feed`, which returns whatever output is ready, and
+    `flush` drains the remaining samples at the end of the stream.
+    """
+    def __init__(self, demucs: nn.Module,
+                 dry: float = 0,
+                 num_frames: int = 1,
+                 resample_lookahead: int = 64,
+                 resample_buffer: int = 256):
+        if not demucs.causal:
+            raise ValueError("streaming is only supported for causal models")
+
+        self.demucs = demucs
+        self.lstm_state: Optional[Tuple[Tensor, Tensor]] = None
+        self.conv_state: Optional[List[Tensor]] = None
+        self.dry = dry
+        self.resample_lookahead = resample_lookahead
+        resample_buffer = min(demucs.total_stride, resample_buffer)
+        self.resample_buffer = resample_buffer
+        self.frame_length = demucs.valid_length(1) + demucs.total_stride * (num_frames - 1)
+        self.total_length = self.frame_length + self.resample_lookahead
+        self.stride = demucs.total_stride * num_frames
+        self.resample_in = torch.zeros(1, resample_buffer)
+        self.resample_out = torch.zeros(1, resample_buffer)
+
+        self.frames = 0
+        self.total_time = 0.
+        self.variance = 0.
+        self.pending = torch.zeros(1, 0)
+
+    def reset(self):
+        """Forget all the stream state, so the next `feed` starts a new stream."""
+        self.lstm_state = None
+        self.conv_state = None
+        self.resample_in.zero_()
+        self.resample_out.zero_()
+        self.variance = 0.
+        self.frames = 0
+        self.pending = torch.zeros(1, 0)
+
+    def reset_time_per_frame(self):
+        self.total_time = 0.
+        self.frames = 0
+
+    @property
+    def time_per_frame(self):
+        return self.total_time / self.frames
+
+    def flush(self) -> Tensor:
+        """
+        Pad the pending input with silence and return the last denoised
+        samples. The streamer is reset afterwards.
+        """
+        pending_length = self.pending.shape[1]
+        padding = torch.zeros(1, self.total_length)
+        out = self.feed(padding)
+        self.reset()
+        return out[:, :pending_length]
+
+    def feed(self, wav: Tensor) -> Tensor:
+        """
+        Push new audio, of shape `[length]` or `[1, length]`, and return all
+        the denoised samples that are now available.
+        """
+        begin = time.time()
+        demucs = self.demucs
+        resample_buffer = self.resample_buffer
+        stride = self.stride
+        factor = demucs.resample
+
+        if wav.dim() == 1:
+            wav = wav.unsqueeze(0)
+        if wav.dim() != 2 or wav.shape[0] != 1:
+            raise ValueError("input wav should be mono, of shape [length] or [1, length]")
+
+        self.pending = torch.cat([self.pending, wav], dim=1)
+        outs = []
+        with torch.no_grad():
+            while self.pending.shape[1] >= self.total_length:
+                self.frames += 1
+                frame = self.pending[:, :self.total_length]
+                dry_signal = frame[:, :stride]
+                if demucs.normalize:
+                    mono = frame.mean(0)
+                    variance = (mono**2).mean().item()
+                    self.variance = variance / self.frames + (1 - 1 / self.frames) * self.variance
+                    frame = frame / (demucs.floor + math.sqrt(self.variance))
+                padded_frame = torch.cat([self.resample_in, frame], dim=-1)
+                self.resample_in[:] = frame[:, stride - resample_buffer:stride]
+                frame = padded_frame
+
+                frame = demucs.upsample(frame)
+                frame = frame[:, factor * resample_buffer:]  # remove pre sampling buffer
+                frame = frame[:, :factor * self.frame_length]  # remove extra samples after window
+
+                out, extra = self._separate_frame(frame)
+                padded_out = torch.cat([self.resample_out, out, extra], 1)
+                self.resample_out[:] = out[:, -resample_buffer:]
+                out = demucs.downsample(padded_out)
+
+                out = out[:, resample_buffer // factor:]
+                out = out[:, :stride]
+
+                if demucs.normalize:
+                    out = out * math.sqrt(self.variance)
+                out = self.dry * dry_signal + (1 - self.dry) * out
+                outs.append(out)
+                self.pending = self.pending[:, stride:]
+
+        self.total_time += time.time() - begin
+        if outs:
+            return torch.cat(outs, 1)
+        return torch.zeros(1, 0)
+
+    def _lstm(self, x: Tensor) -> Tensor:
+        demucs = self.demucs
+        quantized = getattr(demucs, 'quantize_opts', {}).get('lstm', False)
+        if quantized:
+            x = demucs.quant(x)
+        x, self.lstm_state = demucs.lstm(x, self.lstm_state)
+        if quantized:
+            x = demucs.dequant(x)
+        return x
+
+    def _separate_frame(self, frame: Tensor) -> Tuple[Tensor, Tensor]:
+        demucs = self.demucs
+        skips = []
+        next_state = []
+        first = self.conv_state is None
+        stride = self.stride * demucs.resample
+        x = frame[None]
+        for idx, encode in enumerate(demucs.encoder):
+            stride //= demucs.stride
+            length = x.shape[2]
+            if idx == demucs.depth - 1:
+                # the last layer only sees a handful of samples, so it is
+                # cheaper to recompute it than to track its state
+                x = encode(x)
+            else:
+                if not first:
+                    prev = self.conv_state.pop(0)
+                    prev = prev[..., stride:]
+                    tgt = (length - demucs.kernel_size) // demucs.stride + 1
+                    missing = tgt - prev.shape[-1]
+                    offset = length - demucs.kernel_size - demucs.stride * (missing - 1)
+                    x = x[..., offset:]
+                x = encode(x)
+                if not first:
+                    x = torch.cat([prev, x], -1)
+                next_state.append(x)
+            skips.append(x)
+
+        x = x.permute(2, 0, 1)
+        x = self._lstm(x)
+        x = x.permute(1, 2, 0)
+        # x only holds the samples for which every time position is covered
+        # by two windows of the upper layer. extra holds the samples to the
+        # right, only used as a better padding for the online resampling.
+        extra = None
+        for idx, decode in enumerate(demucs.decoder):
+            pre, conv_tr, post, bias = _split_decode(decode)
+            skip = skips.pop(-1)
+            x = x + skip[..., :x.shape[-1]]
+            x = pre(x)
+
+            if extra is not None:
+                skip = skip[..., x.shape[-1]:]
+                extra = extra + skip[..., :extra.shape[-1]]
+                extra = conv_tr(pre(extra))
+            x = conv_tr(x)
+            next_state.append(x[..., -demucs.stride:] - bias.view(-1, 1))
+            if extra is None:
+                extra = x[..., -demucs.stride:]
+            else:
+                extra[..., :demucs.stride] += next_state[-1]
+            x = x[..., :-demucs.stride]
+
+            if not first:
+                prev = self.conv_state.pop(0)
+                x[..., :demucs.stride] += prev
+            x = post(x)
+            extra = post(extra)
+        self.conv_state = next_state
+        return x[0], extra[0]
@@ -0,0 +1,112 @@
+"""
+Losses and a short fine-tuning loop shared by the model compression tools
+(pruning, quantization aware training, distillation).
+
+Batches are (noisy, clean, lengths) triples as produced by
+`data.valentini.dataset.collate_padded`; padding past `lengths` is excluded
+from every loss.
+"""
+import itertools
+import time
+
+import torch
+from torch import nn, Tensor
+from torch.nn import functional as F
+
+from typing import Callable, Iterable, Optional, Sequence, Tuple
+
+Batch = Tuple[Tensor, Tensor, Tensor]
+
+# (fft size, hop, window) of the multi resolution STFT loss, as in facebookresearch/denoiser
+STFT_RESOLUTIONS = ((512, 50, 240), (1024, 120, 600), (2048, 240, 1200))
+
+
+def length_mask(x: Tensor, lengths: Optional[Tensor]) -> Tensor:
+    """[B, 1, T] mask of the real samples of `x`, of shape [B, C, T]."""
+    if lengths is None:
+        return torch.ones_like(x[:, :1])
+    return (torch.arange(x.shape[-1], device=x.device) < lengths.view(-1, 1, 1)).to(x.dtype)
+
+
+def _magnitude(x: Tensor, fft_size: int, hop: int, window: int) -> Tensor:
+    spec = torch.stft(x.reshape(-1, x.shape[-1]), fft_size, hop, window,
+                      torch.hann_window(window, device=x.device), return_complex=True)
+    return spec.abs().clamp(min=1e-7)
+
+
+def stft_loss(estimate: Tensor, target: Tensor, lengths: Optional[Tensor] = None,
+              resolutions: Sequence[Tuple[int, int, int]] = STFT_RESOLUTIONS) -> Tensor:
+    """
+    Multi resolution STFT loss: spectral convergence plus log magnitude
+    distance, averaged over `resolutions`.
+    """
+    mask = length_mask(estimate, lengths)
+    estimate, target = estimate * mask, target * mask
+    loss = 0.
+    for fft_size, hop, window in resolutions:
+        est, ref = _magnitude(estimate, fft_size, hop, window), _magnitude(target, fft_size, hop, window)
+        convergence = torch.norm(ref - est, p="fro") / torch.norm(ref, p="fro")
+        log_magnitude = F.l1_loss(est.log(), ref.log())
+        loss = loss + convergence + log_magnitude
+    return loss / len(resolutions)
+
+
+def l1_loss(estimate: Tensor, target: Tensor, lengths: Optional[Tensor] = None) -> Tensor:
+    mask = length_mask(estimate, lengths)
+    return ((estimate - target).abs() * mask).sum() / (mask.sum() * estimate.shape[1])
+
+
+def waveform_loss(estimate: Tensor, target: Tensor, lengths: Optional[Tensor] = None,
+                  stft_weight: float = 1.) -> Tensor:
+    """L1 on the waveform plus `stft_weight` times the multi resolution STFT loss."""
+    loss = l1_loss(estimate, target, lengths)
+    if stft_weight:
+        loss = loss + stft_weight * stft_loss(estimate, target, lengths)
+    return loss
+
+
+def denoising_loss(model: nn.Module, batch: Batch) -> Tensor:
+    noisy, clean, lengths = batch
+    return waveform_loss(model(noisy, lengths), clean, lengths)
+
+
+def finetune(model: nn.Module, batches: Iterable[Batch], steps: int, lr: float = 3e-4,
+             loss_fn: Callable[[nn.Module, Batch], Tensor] = denoising_loss,
+             log_every: int = 50) -> nn.Module:
+    """
+    Train `model` for `steps` optimizer steps with Adam, cycling over
+    `batches` (a DataLoader, for instance) as often as needed. `loss_fn`
+    maps (model, batch) to the loss; the default trains on the clean target.
+    Returns the model, left in eval mode.
+    """
+    optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=lr, betas=(0.9, 0.999))
+    model.train()
+    start = time.perf_counter()
+    running, count = 0., 0
+    for step, batch in enumerate(itertools.islice(_cycle(batches), steps), 1):
+        loss = loss_fn(model, batch)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        running, count = running + loss.item(), count + 1
+        if step % log_every == 0 or step == steps:
+            print(f"step {step}/{steps}: loss {running / count:.4f} ({time.perf_counter() - start:.0f}s)")
+            running, count = 0., 0
+    model.eval()
+    return model
+
+
+def _cycle(batches: Iterable[Batch]):
+    epoch = 0
+    while True:
+        # reshuffle bucketed samplers every pass
+        sampler = getattr(batches, "batch_sampler", None)
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(epoch)
+        empty = True
+        for batch in batches:
+            empty = False
+            yield batch
+        if empty:
+            raise ValueError("no training batches")
+        epoch += 1
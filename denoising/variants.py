@@ -0,0 +1,98 @@
+"""
+The model variants we compare and ship to the Android app, described as data
+so they can be built, fingerprinted and exported by name.
+"""
+import hashlib
+import json
+import os
+
+import torch
+import torchaudio
+from torch import nn
+from torchaudio.functional import resample
+
+from typing import Any, Dict, Optional
+
+from . import registry
+from .demucs import load_pretrained_demucs
+from .quantized_demucs import QuantizedDemucs, calibration_data_hash
+
+CALIBRATION_AUDIO = os.path.join(os.path.dirname(os.path.dirname(__file__)), "alex_noisy.mp3")
+# the modules a built variant depends on; edits elsewhere in the package do not change its fingerprint
+SOURCES = ["demucs.py", "quantized_demucs.py", "registry.py", "variants.py"]
+
+VARIANTS: Dict[str, Dict[str, Any]] = {
+    # no quantization, base model
+    "pretrained": dict(name="dns48"),
+    # dynamic lstm
+    "dynamic_only": dict(name="dns48", quantize_opts=dict(encoder=False, lstm=False), dynamic=torch.qint8),
+    # static encoder + static lstm
+    "static_only": dict(name="dns48", quantize_opts=dict(encoder=True, lstm=True)),
+    # static encoder
+    "static_encoder_only": dict(name="dns48", quantize_opts=dict(encoder=True, lstm=False)),
+    # static lstm
+    "static_lstm_only": dict(name="dns48", quantize_opts=dict(encoder=False, lstm=True)),
+    # static encoder + dynamic lstm
+    "static_and_dynamic": dict(name="dns48", quantize_opts=dict(encoder=True, lstm=False), dynamic=torch.qint8),
+    # static encoder + static lstm + static decoder
+    "static_full": dict(name="dns48", quantize_opts=dict(encoder=True, lstm=True, decoder=True)),
+}
+
+
+def is_static(variant: str) -> bool:
+    return any(VARIANTS[variant].get("quantize_opts", {}).values())
+
+
+def load_calibration_audio(path: str = CALIBRATION_AUDIO, sample_rate: int = 16000) -> torch.Tensor:
+    noisy, fs = torchaudio.load(path)
+    return resample(noisy, fs, sample_rate)
+
+
+def build_variant(variant: str, sample_audio: Optional[torch.Tensor] = None,
+                  calibration_cache: Optional[str] = None) -> nn.Module:
+    """
+    Build the eager model for `variant`. Static variants calibrate on
+    `sample_audio`, loaded from `CALIBRATION_AUDIO` if not given.
+    """
+    if variant not in VARIANTS:
+        raise ValueError(f"variant needs to be in {list(VARIANTS.keys())}")
+    spec = VARIANTS[variant]
+    if "quantize_opts" not in spec:
+        return load_pretrained_demucs(spec["name"])
+
+    if is_static(variant) and sample_audio is None:
+        sample_audio = load_calibration_audio()
+    return QuantizedDemucs.from_facebook_pretrained(spec["name"], spec["quantize_opts"],
+                                                    dynamic=spec.get("dynamic"),
+                                                    sample_audio=sample_audio if is_static(variant) else None,
+                                                    calibration_cache=calibration_cache)
+
+
+def _source_hash() -> str:
+    digest = hashlib.sha256()
+    for name in SOURCES:
+        with open(os.path.join(os.path.dirname(__file__), name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def fingerprint(variant: str, sample_audio: Optional[torch.Tensor] = None) -> str:
+    """
+    Hash of everything a built variant depends on: the checkpoint (whose file
+    name carries its hash) and kwargs, the quantization recipe, the
+    calibration audio, the torch version and the model code.
+    """
+    spec = VARIANTS[variant]
+    entry = registry.entries()[spec["name"]]
+    inputs = dict(variant=variant,
+                  checkpoint=entry["file"],
+                  kwargs=entry.get("kwargs", {}),
+                  quantize_opts=sorted(spec.get("quantize_opts", {}).items()),
+                  dynamic=str(spec.get("dynamic")),
+                  torch=torch.__version__,
+                  source=_source_hash())
+    if is_static(variant):
+        if sample_audio is None:
+            sample_audio = load_calibration_audio()
+        inputs["calibration"] = calibration_data_hash(sample_audio)
+    return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
@@ -0,0 +1,112 @@
+"""
+Allocation-light execution of `Demucs` (and `QuantizedDemucs`) for repeated
+calls with the same input shape, such as streaming frames or fixed-length
+batches.
+
+`WorkspaceRunner` computes the same function as `model.forward`, but keeps a
+workspace per input shape, dtype and device: the normalized, zero padded
+input and the LSTM input are staged into buffers allocated on the first call
+and reused after, the skip connections are added in place into the encoder
+outputs (which are not needed afterwards), and the output is rescaled in
+place. The LSTM input is copied once into a contiguous time-major buffer
+instead of going through a non-contiguous permute.
+
+Convolution, resampling and LSTM outputs still come from the allocator:
+eager PyTorch has no out= variant for them, so those buffers are only
+recycled through the caching allocator.
+
+A runner is not thread safe, since concurrent calls with the same shape
+would share one workspace; give each thread its own runner.
+"""
+import torch
+from torch import nn, Tensor
+
+from typing import Dict, Optional, Tuple
+
+from .demucs import masked_std
+
+WorkspaceKey = Tuple[Tuple[int, ...], torch.dtype, torch.device]
+
+
+class WorkspaceRunner:
+    """
+    Args:
+        - model (nn.Module): a `Demucs` or `QuantizedDemucs`, in eval mode.
+        - max_shapes (int): number of input shapes (with their dtype and
+            device) whose workspace is kept, the least recently used one is
+            dropped beyond that.
+
+    Not thread safe, use one runner per thread.
+    """
+    def __init__(self, model: nn.Module, max_shapes: int = 8):
+        self.model = model.eval()
+        self.max_shapes = max_shapes
+        self.workspaces: Dict[WorkspaceKey, Dict[str, Tensor]] = {}
+
+    def _workspace(self, mix: Tensor) -> Dict[str, Tensor]:
+        key = (tuple(mix.shape), mix.dtype, mix.device)
+        workspace = self.workspaces.pop(key, None)
+        if workspace is None:
+            if len(self.workspaces) >= self.max_shapes:
+                self.workspaces.pop(next(iter(self.workspaces)))
+            batch, channels, length = mix.shape
+            # the tail past `length` is zeroed here once and never written
+            workspace = dict(padded=torch.zeros(batch, channels, self.model.valid_length(length),
+                                                dtype=mix.dtype, device=mix.device))
+        # reinsert, so iteration order is least recently used first
+        self.workspaces[key] = workspace
+        return workspace
+
+    def _lstm_input(self, workspace: Dict[str, Tensor], x: Tensor) -> Tensor:
+        batch, channels, steps = x.shape
+        buffer = workspace.get("lstm")
+        if buffer is None:
+            buffer = workspace["lstm"] = torch.empty(steps, batch, channels, dtype=x.dtype, device=x.device)
+        return buffer.copy_(x.permute(2, 0, 1))
+
+    @torch.inference_mode()
+    def __call__(self, mix: Tensor, lengths: Optional[Tensor] = None, out: Optional[Tensor] = None) -> Tensor:
+        """
+        Denoise `mix` of shape [B, C, T] (or [B, T]). The result is written
+        into `out` when given, so callers can reuse their output buffer too.
+        """
+        model = self.model
+        if mix.dim() == 2:
+            mix = mix.unsqueeze(1)
+        length = mix.shape[-1]
+        workspace = self._workspace(mix)
+
+        x = workspace["padded"]
+        head = x[..., :length]
+        head.copy_(mix)
+        if model.normalize:
+            mono = mix.mean(dim=1, keepdim=True)
+            std = mono.std(dim=-1, keepdim=True) if lengths is None else masked_std(mono, lengths)
+            head.div_(std + model.floor)
+        x = model.upsample(x)
+
+        skips = []
+        for encode in model.encoder:
+            x = encode(x)
+            skips.append(x)
+
+        quantized_lstm = getattr(model, "quantize_opts", {}).get("lstm", False)
+        x = self._lstm_input(workspace, x)
+        if quantized_lstm:
+            x = model.quant(x)
+        x, _ = model.lstm(x)
+        if quantized_lstm:
+            x = model.dequant(x)
+        x = x.permute(1, 2, 0)
+
+        for decode in model.decoder:
+            skip = skips.pop(-1)
+            # at a valid length the decoder output covers the whole skip, so
+            # the sum lands in the contiguous encoder output
+            x = decode(skip[..., :x.shape[-1]].add_(x))
+        x = model.downsample(x)[..., :length]
+        if model.normalize:
+            x.mul_(std)
+        if out is not None:
+            return out.copy_(x)
+        return x
@@ -0,0 +1,76 @@
+"""
+Distill smaller Demucs students from a pretrained teacher on the Valentini
+train set, and report the latency / quality tradeoff of each.
+
+    python distill_model.py --steps 20000                     # every student
+    python distill_model.py student_32_r2 --teacher dns64 --register
+
+Latency is the median time to denoise one second of audio on this machine
+(so below 1000 ms is real time), quality is PESQ / SI-SNR on the first
+--eval-files clips of the Valentini test set. With --register, students are
+saved to the model registry and can then be loaded by name like the
+pretrained models (load_pretrained_demucs, QuantizedDemucs.from_facebook_pretrained).
+"""
+import argparse
+import os
+
+import torch
+from torch.utils.data import DataLoader
+
+from data.valentini import dataset
+from denoising import distillation, precision, pruning, registry
+from denoising.demucs import load_pretrained_demucs
+
+SAMPLE_RATE = 16000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distill smaller Demucs students from a pretrained teacher.")
+    parser.add_argument("students", nargs="*",
+                        help=f"student configurations, out of {', '.join(distillation.STUDENTS)} (default: all)")
+    parser.add_argument("--teacher", default="dns48")
+    parser.add_argument("--steps", type=int, default=10000)
+    parser.add_argument("--lr", type=float, default=3e-4)
+    parser.add_argument("--alpha", type=float, default=0.5, help="weight of the teacher target versus the clean one")
+    parser.add_argument("--batch-seconds", type=float, default=64., help="audio per batch, in seconds")
+    parser.add_argument("--workers", type=int, default=2, help="data loading processes")
+    parser.add_argument("--eval-files", type=int, default=50)
+    parser.add_argument("--output-dir", default="students")
+    parser.add_argument("--register", action="store_true", help="add the students to the model registry")
+    args = parser.parse_args()
+
+    names = args.students or list(distillation.STUDENTS)
+    unknown = [name for name in names if name not in distillation.STUDENTS]
+    if unknown:
+        parser.error(f"unknown students: {', '.join(unknown)}")
+
+    teacher = load_pretrained_demucs(args.teacher).eval()
+    trainset = dataset.indexed_trainset(SAMPLE_RATE)
+    sampler = dataset.BucketBatchSampler(trainset.lengths, int(args.batch_seconds * SAMPLE_RATE), shuffle=True)
+    loader = DataLoader(trainset, batch_sampler=sampler, collate_fn=dataset.collate_padded,
+                        num_workers=args.workers, persistent_workers=args.workers > 0)
+    testset = dataset.indexed_testset(SAMPLE_RATE)
+    pairs = [testset[i] for i in range(min(args.eval_files, len(testset)))]
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    rows = [(args.teacher, teacher, None)]
+    for name in names:
+        print(f"distilling {name}")
+        student = distillation.distill(teacher, distillation.STUDENTS[name], loader, args.steps, args.lr, args.alpha)
+        kwargs = distillation.student_kwargs(teacher, distillation.STUDENTS[name])
+        torch.save(dict(kwargs=kwargs, state=student.state_dict()), os.path.join(args.output_dir, f"{name}.pt"))
+        if args.register:
+            print(f"registered {registry.register(name, student.state_dict(), kwargs)}")
+        rows.append((name, student, kwargs))
+
+    print(f"{'model':>20} {'params':>8} {'GFLOPs/s':>9} {'ms/s':>8} {'PESQ':>6} {'SI-SNR':>7}")
+    for name, model, _ in rows:
+        report = precision.quality_report(teacher, model, pairs) if pairs else {}
+        params = sum(p.numel() for p in model.parameters())
+        print(f"{name:>20} {params / 1e6:>7.3f}M {pruning.count_flops(model) / 1e9:>9.3f} "
+              f"{pruning.measure_latency(model) * 1e3:>8.2f} {report.get('candidate_pesq', float('nan')):>6.3f} "
+              f"{report.get('candidate_snr', float('nan')):>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
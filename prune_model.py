@@ -0,0 +1,77 @@
+"""
+Prune a pretrained Demucs to a FLOP or latency budget, fine-tune it on the
+Valentini train set, and report size, FLOPs and latency before and after.
+
+    python prune_model.py --flops 2.0 --steps 2000 --output pruned/dns48-2gflops.pt
+    python prune_model.py --latency 20 --steps 500
+
+The budgets are per second of 16 kHz audio: --flops in GFLOPs, --latency in
+milliseconds on this machine. The pruned model is saved with the widths it
+was built with; load it back with `denoising.pruning.load_pruned`.
+"""
+import argparse
+import io
+import os
+
+import torch
+from torch.utils.data import DataLoader
+
+from data.valentini import dataset
+from denoising import pruning, training
+from denoising.demucs import load_pretrained_demucs
+
+SAMPLE_RATE = 16000
+
+
+def report(name, model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    params = sum(p.numel() for p in model.parameters())
+    print(f"{name:>10}: {params / 1e6:7.3f}M params, {buffer.tell() / 2 ** 20:7.2f} MiB, "
+          f"{pruning.count_flops(model) / 1e9:7.3f} GFLOPs/s, {pruning.measure_latency(model) * 1e3:7.2f} ms/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Structured channel pruning of a pretrained Demucs.")
+    parser.add_argument("--name", default="dns48", help="pretrained model to prune")
+    budget = parser.add_mutually_exclusive_group(required=True)
+    budget.add_argument("--flops", type=float, help="GFLOPs per second of audio")
+    budget.add_argument("--latency", type=float, help="milliseconds per second of audio")
+    budget.add_argument("--ratio", type=float, help="fraction of channels to keep, instead of a budget")
+    parser.add_argument("--multiple", type=int, default=4, help="round channel counts to a multiple of this")
+    parser.add_argument("--steps", type=int, default=1000, help="fine-tuning steps (0 to skip)")
+    parser.add_argument("--lr", type=float, default=1e-4)
+    parser.add_argument("--batch-seconds", type=float, default=64., help="audio per batch, in seconds")
+    parser.add_argument("--workers", type=int, default=2, help="data loading processes")
+    parser.add_argument("--output", help="default: pruned/<name>-<widths>.pt")
+    args = parser.parse_args()
+
+    model = load_pretrained_demucs(args.name)
+    model.eval()
+    if args.ratio is not None:
+        spec = pruning.scaled_spec(model, args.ratio, args.multiple)
+        pruned = pruning.prune(model, spec)
+    else:
+        pruned, spec = pruning.prune_to_budget(
+            model, flops=args.flops * 1e9 if args.flops is not None else None,
+            latency=args.latency / 1e3 if args.latency is not None else None, multiple=args.multiple)
+    print(f"widths: hidden {spec['hidden']}, skip {spec['skip']}, glu {spec['glu']}")
+
+    if args.steps:
+        trainset = dataset.indexed_trainset(SAMPLE_RATE)
+        sampler = dataset.BucketBatchSampler(trainset.lengths, int(args.batch_seconds * SAMPLE_RATE), shuffle=True)
+        loader = DataLoader(trainset, batch_sampler=sampler, collate_fn=dataset.collate_padded,
+                            num_workers=args.workers, persistent_workers=args.workers > 0)
+        training.finetune(pruned, loader, args.steps, args.lr)
+
+    report("original", model)
+    report("pruned", pruned)
+
+    output = args.output or os.path.join("pruned", f"{args.name}-{'-'.join(map(str, spec['skip']))}.pt")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    pruning.save_pruned(pruned, spec, output)
+    print(f"saved {output}")
+
+
+if __name__ == "__main__":
+    main()
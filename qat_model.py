@@ -0,0 +1,73 @@
+"""
+Quantization aware training of a pretrained Demucs on the Valentini train
+set, exported as an int8 lite-interpreter model for the Android app.
+
+    python qat_model.py --steps 4000                          # fully static dns48
+    python qat_model.py --name dns64 --no-decoder --output qat_dns64.ptl
+
+PESQ / SI-SNR of the float and int8 models on the first --eval-files clips of
+the Valentini test set are printed at the end.
+"""
+import argparse
+import os
+
+import torch
+from torch.quantization import quantize_dynamic
+from torch.utils.data import DataLoader
+from torch.utils.mobile_optimizer import optimize_for_mobile
+
+from data.valentini import dataset
+from denoising import precision, qat
+from denoising.demucs import load_pretrained_demucs
+from torchscript_model import OUTPUT_DIR
+
+SAMPLE_RATE = 16000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantization aware training of QuantizedDemucs.")
+    parser.add_argument("--name", default="dns48", help="pretrained model to start from")
+    for part in ("encoder", "lstm", "decoder"):
+        parser.add_argument(f"--no-{part}", action="store_true", help=f"keep the {part} in float")
+    parser.add_argument("--dynamic-lstm", action="store_true", help="quantize a float LSTM dynamically after conversion")
+    parser.add_argument("--per-channel", action="store_true", help="per-channel Conv1d weights")
+    parser.add_argument("--steps", type=int, default=2000)
+    parser.add_argument("--lr", type=float, default=1e-5)
+    parser.add_argument("--freeze-observers", type=float, default=0.5,
+                        help="fraction of the steps after which quantization ranges are frozen")
+    parser.add_argument("--batch-seconds", type=float, default=64., help="audio per batch, in seconds")
+    parser.add_argument("--workers", type=int, default=2, help="data loading processes")
+    parser.add_argument("--eval-files", type=int, default=50)
+    parser.add_argument("--output", help=f"default: {OUTPUT_DIR}/qat_<name>.ptl")
+    args = parser.parse_args()
+
+    quantize_opts = dict(encoder=not args.no_encoder, lstm=not args.no_lstm, decoder=not args.no_decoder)
+    if not any(quantize_opts.values()):
+        parser.error("nothing left to quantize")
+    model = qat.prepare(args.name, quantize_opts, args.per_channel)
+
+    trainset = dataset.indexed_trainset(SAMPLE_RATE)
+    sampler = dataset.BucketBatchSampler(trainset.lengths, int(args.batch_seconds * SAMPLE_RATE), shuffle=True)
+    loader = DataLoader(trainset, batch_sampler=sampler, collate_fn=dataset.collate_padded,
+                        num_workers=args.workers, persistent_workers=args.workers > 0)
+    qat.train(model, loader, args.steps, args.lr, args.freeze_observers)
+
+    quantized = qat.convert_trained(model)
+    if args.dynamic_lstm and not quantize_opts["lstm"]:
+        quantized = quantize_dynamic(quantized, qconfig_spec={torch.nn.LSTM}, dtype=torch.qint8)
+
+    output = args.output or os.path.join(OUTPUT_DIR, f"qat_{args.name}.ptl")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    optimize_for_mobile(torch.jit.script(quantized))._save_for_lite_interpreter(output)
+    print(f"saved {output} ({os.path.getsize(output) / 2 ** 20:.2f} MiB)")
+
+    if args.eval_files:
+        testset = dataset.indexed_testset(SAMPLE_RATE)
+        pairs = [testset[i] for i in range(min(args.eval_files, len(testset)))]
+        report = precision.quality_report(load_pretrained_demucs(args.name).eval(), quantized, pairs)
+        print(f"float: PESQ {report['reference_pesq']:.3f}, SI-SNR {report['reference_snr']:.2f} dB")
+        print(f" int8: PESQ {report['candidate_pesq']:.3f}, SI-SNR {report['candidate_snr']:.2f} dB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Local denoising service.
+
+    python serve.py --variant dynamic_only --port 8000
+    curl --data-binary @noisy.wav http://localhost:8000/denoise -o denoised.wav
+    curl http://localhost:8000/stats
+
+POST /denoise takes a WAV file (any rate, mixed down to mono) and streams
+back the denoised audio as 16-bit WAV at the model sample rate. Requests
+arriving within --max-wait-ms of each other are denoised in one batched
+forward pass on a dedicated inference thread pool. GET /stats reports the
+queue depth and latency percentiles. Use --unix to listen on a Unix socket.
+With --compile, the model is compiled for a fixed set of length buckets and
+batch sizes at startup, so short requests skip the eager dispatch overhead.
+With --precision bfloat16, the convolutions run in bfloat16 once the model
+passes a PESQ / SI-SNR check against the float model on --gate-files clips of
+the Valentini test set.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from torchaudio.functional import resample
+
+import wav_parser
+from denoising import precision, variants
+from denoising.compiled import BACKENDS, CompiledDemucs
+from denoising.inference import denoise_batch
+
+STREAM_FRAMES = 16384
+# an hour of 16 kHz 16-bit mono is ~115 MB
+MAX_BODY_BYTES = 256 * 2 ** 20
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class MicroBatcher:
+    """
+    Groups concurrent requests into batches. A batch starts as soon as an
+    inference worker is free and a request is waiting, then takes whatever
+    else arrives within `max_wait` seconds, up to `max_batch` requests.
+    """
+    def __init__(self, model, max_batch=16, max_wait=0.01, workers=1):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='inference')
+        self.slots = asyncio.Semaphore(workers)
+        self.latencies = deque(maxlen=10000)
+        self.batch_sizes = deque(maxlen=10000)
+        self.in_flight = 0
+        self._tasks = set()
+
+    async def denoise(self, wav: torch.Tensor) -> torch.Tensor:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((wav, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # keep a reference, the loop only holds tasks weakly
+            task = asyncio.create_task(self._infer(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _infer(self, batch):
+        loop = asyncio.get_running_loop()
+        self.in_flight += len(batch)
+        self.batch_sizes.append(len(batch))
+        try:
+            outs = await loop.run_in_executor(self.executor, denoise_batch, self.model,
+                                              [wav for wav, _ in batch], len(batch))
+            for (_, future), out in zip(batch, outs):
+                if not future.done():
+                    future.set_result(out)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.in_flight -= len(batch)
+            self.slots.release()
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1e3
+
+        return dict(queue_depth=self.queue.qsize(),
+                    in_flight=self.in_flight,
+                    requests=len(latencies),
+                    mean_batch_size=sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else None,
+                    latency_ms=dict(p50=percentile(50), p90=percentile(90), p99=percentile(99)))
+
+
+async def read_request(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, path, _ = line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise RequestError('400 Bad Request', 'malformed request line')
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise RequestError('400 Bad Request', 'invalid Content-Length')
+    if length < 0:
+        raise RequestError('400 Bad Request', 'invalid Content-Length')
+    if length > MAX_BODY_BYTES:
+        # checked before reading, the body is never buffered
+        raise RequestError('413 Payload Too Large', f'request bodies are limited to {MAX_BODY_BYTES} bytes')
+    body = await reader.readexactly(length)
+    return method, path, headers, body
+
+
+async def respond(writer, status, content_type, body):
+    writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                 f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+
+
+async def stream_wav(writer, samples, sample_rate):
+    def chunk(data):
+        return f'{len(data):x}\r\n'.encode() + data + b'\r\n'
+
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: audio/wav\r\nTransfer-Encoding: chunked\r\n\r\n')
+    writer.write(chunk(wav_parser.wav_header(len(samples), sample_rate)))
+    for start in range(0, len(samples), STREAM_FRAMES):
+        writer.write(chunk(wav_parser.to_pcm16(samples[start:start + STREAM_FRAMES])))
+        await writer.drain()
+    writer.write(b'0\r\n\r\n')
+    await writer.drain()
+
+
+def make_handler(batcher, sample_rate):
+    async def handle(reader, writer):
+        try:
+            while (request := await read_request(reader)) is not None:
+                method, path, headers, body = request
+                if method == 'GET' and path == '/stats':
+                    await respond(writer, '200 OK', 'application/json', json.dumps(batcher.stats()).encode())
+                elif method == 'POST' and path == '/denoise':
+                    start = time.perf_counter()
+                    try:
+                        wav = wav_parser.WavFile(body)
+                        noisy = torch.from_numpy(wav.read(mono=True))
+                        if wav.sample_rate != sample_rate:
+                            noisy = resample(noisy, wav.sample_rate, sample_rate)
+                    except Exception as e:
+                        # malformed headers can fail in many ways (zero channels, zero rate, ...)
+                        await respond(writer, '400 Bad Request', 'text/plain', f'invalid WAV file: {e}'.encode())
+                        continue
+                    try:
+                        denoised = await batcher.denoise(noisy)
+                    except Exception as e:
+                        await respond(writer, '500 Internal Server Error', 'text/plain',
+                                      f'{type(e).__name__}: {e}'.encode())
+                        continue
+                    await stream_wav(writer, denoised.numpy(), sample_rate)
+                    batcher.latencies.append(time.perf_counter() - start)
+                else:
+                    await respond(writer, '404 Not Found', 'text/plain', b'not found')
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except RequestError as e:
+            # the unread body leaves the stream out of sync, so answer and close
+            try:
+                await respond(writer, e.status, 'text/plain', str(e).encode())
+            except ConnectionError:
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+
+async def main(args):
+    # split the cores between the inference workers instead of oversubscribing them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.workers))
+    model = variants.build_variant(args.variant, calibration_cache='.calibration')
+    model.eval()
+    if args.precision != 'float32':
+        from data.valentini import dataset
+        testset = dataset.indexed_testset(model.sample_rate)
+        pairs = [testset[i] for i in range(min(args.gate_files, len(testset)))]
+        model = precision.reduced_precision(model, pairs, precision.DTYPES[args.precision])
+        report = model.report
+        print(f"{args.precision}: PESQ {report['candidate_pesq']:.3f} (float {report['reference_pesq']:.3f}), "
+              f"SI-SNR {report['candidate_snr']:.2f} dB (float {report['reference_snr']:.2f}), "
+              f"agreement {report['agreement_snr']:.1f} dB")
+    if args.compile:
+        # powers of two up to --max-batch, so a padded batch at most doubles
+        batch_sizes = sorted({min(2 ** i, args.max_batch) for i in range(args.max_batch.bit_length() + 1)})
+        model = CompiledDemucs(model, args.buckets, batch_sizes, backend=args.compile)
+
+    batcher = MicroBatcher(model, args.max_batch, args.max_wait_ms / 1e3, args.workers)
+    runner = asyncio.create_task(batcher.run())
+    handler = make_handler(batcher, model.sample_rate)
+    if args.unix:
+        server = await asyncio.start_unix_server(handler, path=args.unix)
+    else:
+        server = await asyncio.start_server(handler, args.host, args.port)
+    print(f'serving {args.variant} on {args.unix or f"{args.host}:{args.port}"}')
+    async with server:
+        await server.serve_forever()
+    runner.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local denoising service with dynamic micro-batching.')
+    parser.add_argument('--variant', default='pretrained', help=f"one of {', '.join(variants.VARIANTS)}")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix', help='listen on this Unix socket path instead of TCP')
+    parser.add_argument('--max-batch', type=int, default=16)
+    parser.add_argument('--max-wait-ms', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=2, help='inference threads')
+    parser.add_argument('--precision', choices=['float32', *precision.DTYPES], default='float32',
+                        help='reduced precision convolutions, for the float variants')
+    parser.add_argument('--gate-files', type=int, default=32, help='reference clips for the --precision check')
+    parser.add_argument('--compile', choices=BACKENDS, help='compile the model instead of running it eagerly')
+    parser.add_argument('--buckets', type=float, nargs='+', default=[1, 2, 4, 8],
+                        help='input lengths in seconds to compile for, with --compile')
+    asyncio.run(main(parser.parse_args()))
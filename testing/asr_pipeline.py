@@ -0,0 +1,198 @@
+## Denoise-then-transcribe evaluation over a corpus of clips
+## Every audio file in the given directories with a sibling .txt reference is
+## loaded and resampled to 16 kHz in memory, denoised in length-bucketed batches,
+## and transcribed by each ASR model, loaded once. Original and denoised audio are
+## transcribed concurrently, Wav2Vec2 inputs are padded into batches, and
+## transcripts are memoized per (audio, model), so reruns only transcribe what changed.
+##
+##   python testing/asr_pipeline.py testing/audios --variant dynamic_only --asr wav2vec2 deepspeech
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import torch
+import torchaudio
+from torchaudio.functional import resample
+
+import scoring
+from denoising import variants
+from denoising.inference import denoise_batch
+
+SAMPLE_RATE = 16000
+CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.asr_cache', 'transcripts.jsonl')
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.mp3', '.m4a', '.ogg')
+DEEPSPEECH_URL = 'https://github.com/mozilla/DeepSpeech/releases/download/v0.9.3/deepspeech-0.9.3-models.pbmm'
+
+
+class Wav2Vec2Transcriber:
+    def __init__(self, name='facebook/wav2vec2-base-960h', batch_size=8):
+        from transformers import Wav2Vec2ForCTC, Wav2Vec2Processor
+        self.key = f'wav2vec2:{name}'
+        self.processor = Wav2Vec2Processor.from_pretrained(name)
+        self.model = Wav2Vec2ForCTC.from_pretrained(name).eval()
+        self.batch_size = batch_size
+
+    def __call__(self, waveforms):
+        # batch clips of similar length so padding stays small
+        order = sorted(range(len(waveforms)), key=lambda i: len(waveforms[i]))
+        texts = [None] * len(waveforms)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            inputs = self.processor([waveforms[i].numpy() for i in batch], sampling_rate=SAMPLE_RATE,
+                                    return_tensors='pt', padding=True)
+            with torch.no_grad():
+                logits = self.model(inputs.input_values, attention_mask=inputs.get('attention_mask')).logits
+            for i, text in zip(batch, self.processor.batch_decode(torch.argmax(logits, dim=-1))):
+                texts[i] = text
+        return texts
+
+
+class DeepSpeechTranscriber:
+    def __init__(self, model_path='deepspeech-0.9.3-models.pbmm'):
+        import deepspeech
+        if not os.path.exists(model_path):
+            torch.hub.download_url_to_file(DEEPSPEECH_URL, model_path)
+        self.key = f'deepspeech:{os.path.basename(model_path)}'
+        self.model = deepspeech.Model(model_path)
+
+    def __call__(self, waveforms):
+        # the DeepSpeech API takes one 16-bit clip at a time
+        return [self.model.stt((w.clamp(-1, 1) * 32767).round().to(torch.int16).numpy()) for w in waveforms]
+
+
+TRANSCRIBERS = dict(wav2vec2=Wav2Vec2Transcriber, deepspeech=DeepSpeechTranscriber)
+
+
+def find_clips(paths):
+    clips = []
+    for path in paths:
+        files = [path] if os.path.isfile(path) else sorted(glob.glob(os.path.join(path, '**', '*'), recursive=True))
+        for file in files:
+            reference = os.path.splitext(file)[0] + '.txt'
+            if file.lower().endswith(AUDIO_EXTENSIONS) and os.path.exists(reference):
+                clips.append((file, reference))
+    return clips
+
+
+def load_audio(path):
+    waveform, sample_rate = torchaudio.load(path)
+    waveform = waveform.mean(0)
+    if sample_rate != SAMPLE_RATE:
+        waveform = resample(waveform, sample_rate, SAMPLE_RATE)
+    return waveform
+
+
+def load_reference(path):
+    with open(path) as f:
+        return scoring_text(f.read())
+
+
+def scoring_text(text):
+    return ' '.join(text.lower().split())
+
+
+def audio_hash(waveform):
+    return hashlib.sha256(waveform.contiguous().numpy().tobytes()).hexdigest()[:16]
+
+
+class TranscriptCache:
+    def __init__(self, path=CACHE):
+        self.path = path
+        self.entries = {}
+        # original and denoised transcripts are added from different threads
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.entries[(entry['audio'], entry['model'])] = entry['text']
+
+    def get(self, audio, model):
+        return self.entries.get((audio, model))
+
+    def add(self, audio, model, text):
+        with self.lock:
+            self.entries[(audio, model)] = text
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(dict(audio=audio, model=model, text=text)) + '\n')
+
+
+def transcribe_cached(transcriber, cache, keys, waveforms):
+    """Transcripts of `waveforms`, only running the model on the ones not cached yet."""
+    texts = [cache.get(key, transcriber.key) for key in keys]
+    todo = [i for i, text in enumerate(texts) if text is None]
+    if todo:
+        audio = waveforms()
+        for i, text in zip(todo, transcriber([audio[i] for i in todo])):
+            texts[i] = text
+            cache.add(keys[i], transcriber.key, text)
+    return texts
+
+
+def run(paths, variant='dynamic_only', asr=('wav2vec2',), batch_size=16, calibration_cache='.calibration'):
+    clips = find_clips(paths)
+    if not clips:
+        raise ValueError(f"no audio files with a .txt reference in {paths}")
+    references = [load_reference(reference) for _, reference in clips]
+    originals = [load_audio(audio) for audio, _ in clips]
+    original_keys = [audio_hash(w) for w in originals]
+    # denoised audio is keyed by its source and the exact model, so cached
+    # transcripts skip denoising entirely
+    model_key = f'{variant}-{variants.fingerprint(variant)[:12]}'
+    denoised_keys = [f'{key}:{model_key}' for key in original_keys]
+
+    cache = TranscriptCache()
+
+    denoised = []
+
+    def denoised_audio():
+        if not denoised:
+            model = variants.build_variant(variant, calibration_cache=calibration_cache)
+            model.eval()
+            denoised.extend(denoise_batch(model, originals, batch_size))
+        return denoised
+
+    results = {}
+    with ThreadPoolExecutor(1) as pool:
+        for name in asr:
+            # the original audio is transcribed in the background while the
+            # main thread denoises and transcribes the denoised audio; each
+            # thread gets its own instance, the models are not thread safe
+            background, transcriber = TRANSCRIBERS[name](), TRANSCRIBERS[name]()
+            original = pool.submit(transcribe_cached, background, cache, original_keys, lambda: originals)
+            clean = transcribe_cached(transcriber, cache, denoised_keys, denoised_audio)
+            for audio, texts in (('original', original.result()), ('denoised', clean)):
+                corpus = scoring.score_corpus(zip(references, map(scoring_text, texts)))
+                results[(transcriber.key, audio)] = corpus
+
+    return clips, results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='WER of ASR models on original versus denoised audio.')
+    parser.add_argument('paths', nargs='+', help='audio files or directories, each clip with a sibling .txt reference')
+    parser.add_argument('--variant', default='dynamic_only', help=f"one of {', '.join(variants.VARIANTS)}")
+    parser.add_argument('--asr', nargs='+', default=['wav2vec2'], choices=list(TRANSCRIBERS))
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--output', help='write per clip and corpus scores as JSON')
+    args = parser.parse_args()
+
+    clips, results = run(args.paths, args.variant, args.asr, args.batch_size)
+    print(f"{'model':>40} {'audio':>10} {'WER':>8} {'accuracy':>9}")
+    for (model, audio), corpus in results.items():
+        total = corpus['total']
+        print(f"{model:>40} {audio:>10} {total['wer'] * 100:>7.2f}% {total['accuracy']:>8.2f}%")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump([dict(model=model, audio=audio, total=corpus['total'],
+                            clips={clip: score for (clip, _), score in zip(clips, corpus['pairs'])})
+                       for (model, audio), corpus in results.items()], f, indent=2)
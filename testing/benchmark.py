@@ -0,0 +1,235 @@
+## CPU benchmark for the model variants in denoising/variants.py
+## Measures build time, cold and warm latency, real-time factor per clip length,
+## throughput per thread count, inference memory and serialized size.
+## Each variant is first built (filling the calibration cache) and serialized in
+## one process, then measured in a fresh one that always hits the cache, so build
+## time, cold latency and memory do not depend on earlier runs. Memory is the peak
+## RSS during inference, over a baseline taken once the model is built.
+##
+##   python testing/benchmark.py --output before.json
+##   python testing/benchmark.py --output after.json
+##   python testing/benchmark.py --compare before.json after.json
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+import torch
+
+from denoising import variants
+
+SAMPLE_RATE = 16000
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return dict(commit=commit,
+                torch=torch.__version__,
+                python=platform.python_version(),
+                machine=platform.machine(),
+                processor=platform.processor(),
+                cpu_count=os.cpu_count(),
+                quantized_engine=torch.backends.quantized.engine)
+
+
+def timings(fn, trials):
+    times = []
+    for _ in range(trials):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times = np.array(times)
+    return dict(median=float(np.median(times)),
+                p90=float(np.percentile(times, 90)),
+                mean=float(times.mean()),
+                std=float(times.std()))
+
+
+def serialized_size(model):
+    state = io.BytesIO()
+    torch.save(model.state_dict(), state)
+    sizes = dict(state_dict_bytes=state.getbuffer().nbytes)
+    try:
+        script = io.BytesIO()
+        torch.jit.save(torch.jit.script(model), script)
+        sizes['torchscript_bytes'] = script.getbuffer().nbytes
+    except Exception as e:
+        sizes['torchscript_error'] = str(e)
+    return sizes
+
+
+def _cache_files(calibration_cache):
+    if not os.path.isdir(calibration_cache):
+        return set()
+    return set(os.listdir(calibration_cache))
+
+
+def _calibration_state(variant, before, calibration_cache):
+    if not variants.is_static(variant):
+        return 'none'
+    return 'miss' if _cache_files(calibration_cache) - before else 'hit'
+
+
+def _rss(field):
+    # current (VmRSS) or peak (VmHWM) resident set size, Linux only
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    raise OSError(f'no {field} in /proc/self/status')
+
+
+def _reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM to the current RSS (Linux 4.0+)
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+
+def prepare_variant(variant, calibration_cache):
+    """Build `variant` once, filling the calibration cache, and measure its serialized size."""
+    before = _cache_files(calibration_cache)
+    model = variants.build_variant(variant, calibration_cache=calibration_cache)
+    model.eval()
+    result = dict(prepare_calibration=_calibration_state(variant, before, calibration_cache))
+    result.update(serialized_size(model))
+    return result
+
+
+def run_variant(variant, lengths, thread_counts, trials, warmup, calibration_cache):
+    # pin the thread pools before torch does any work in this process
+    torch.set_num_interop_threads(1)
+    torch.set_num_threads(max(thread_counts))
+    if hasattr(os, 'sched_setaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))[:max(thread_counts)]
+        os.sched_setaffinity(0, cpus)
+    torch.manual_seed(0)
+    clips = {seconds: 0.1 * torch.randn(1, 1, int(seconds * SAMPLE_RATE)) for seconds in lengths}
+
+    before = _cache_files(calibration_cache)
+    start = time.perf_counter()
+    model = variants.build_variant(variant, calibration_cache=calibration_cache)
+    model.eval()
+    result = dict(variant=variant, build_seconds=time.perf_counter() - start,
+                  calibration=_calibration_state(variant, before, calibration_cache))
+
+    try:
+        result['baseline_rss_bytes'] = _rss('VmRSS')
+        _reset_peak_rss()
+    except OSError:
+        pass
+
+    with torch.no_grad():
+        shortest = clips[min(lengths)]
+        start = time.perf_counter()
+        model(shortest)
+        result['cold_latency'] = time.perf_counter() - start
+
+        result['latency'] = {}
+        for seconds, clip in clips.items():
+            for _ in range(warmup):
+                model(clip)
+            stats = timings(lambda: model(clip), trials)
+            stats['rtf'] = stats['median'] / seconds
+            result['latency'][str(seconds)] = stats
+
+        result['throughput'] = {}
+        clip = clips[max(lengths)]
+        for threads in thread_counts:
+            torch.set_num_threads(threads)
+            for _ in range(warmup):
+                model(clip)
+            stats = timings(lambda: model(clip), trials)
+            # seconds of audio denoised per wall clock second
+            result['throughput'][str(threads)] = max(lengths) / stats['median']
+        torch.set_num_threads(max(thread_counts))
+
+    if 'baseline_rss_bytes' in result:
+        result['inference_peak_rss_bytes'] = _rss('VmHWM')
+        result['inference_rss_bytes'] = result['inference_peak_rss_bytes'] - result['baseline_rss_bytes']
+    else:
+        # no way to reset the peak here, so this includes building the model;
+        # ru_maxrss is in kilobytes on Linux
+        result['process_peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return result
+
+
+def flatten(result, prefix=''):
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = {r['variant']: flatten(r) for r in json.load(f)['results']}
+    with open(after_path) as f:
+        after = {r['variant']: flatten(r) for r in json.load(f)['results']}
+    for variant in before:
+        if variant not in after:
+            continue
+        print(variant)
+        for metric, old in before[variant].items():
+            new = after[variant].get(metric)
+            if new is None or old == 0:
+                continue
+            print(f'  {metric:<32} {old:>14.6g} -> {new:>14.6g} ({(new - old) / old * 100:+.1f}%)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark denoiser variants on CPU.')
+    parser.add_argument('variants', nargs='*', help=f"out of {', '.join(variants.VARIANTS)} (default: all)")
+    parser.add_argument('--lengths', type=float, nargs='+', default=[1, 4, 10], help='clip lengths in seconds')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--trials', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--calibration-cache', default='.calibration')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='diff two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+
+    selected = args.variants or list(variants.VARIANTS)
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for variant in selected:
+        # building (and calibrating on a cache miss) and scripting happen in
+        # their own process, so the measured process starts from a warm cache
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            prepared = pool.submit(prepare_variant, variant, args.calibration_cache).result()
+        # a fresh process per variant keeps cold latency and memory separate
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(run_variant, variant, args.lengths, args.threads,
+                                 args.trials, args.warmup, args.calibration_cache).result()
+        result.update(prepared)
+        results.append(result)
+        latency = result['latency'][str(min(args.lengths))]
+        memory = result.get('inference_rss_bytes', result.get('process_peak_rss_bytes'))
+        print(f"{variant:<20} cold {result['cold_latency'] * 1e3:8.1f} ms  "
+              f"warm {latency['median'] * 1e3:8.1f} ms  rtf {latency['rtf']:.3f}  "
+              f"rss {memory / 1e6:7.1f} MB  size {result['state_dict_bytes'] / 1e3:8.1f} KB  "
+              f"calibration {result['calibration']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(environment=environment(), config=vars(args), results=results), f, indent=2)
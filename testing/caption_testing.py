@@ -12,7 +12,7 @@ import wave
 import torch
 import torchaudio
 from denoising import quantized_demucs
-import difflib
+import scoring
 from transformers import Wav2Vec2ForCTC, Wav2Vec2Processor
 
 def load_model(model_path):
@@ -33,7 +33,7 @@ def load_reference_text(file_path):
         reference_text = file.read().strip()
     return reference_text
 
-def transcribe_wav2vec(model, file_path):
+def transcribe_wav2vec(model, processor, file_path):
     waveform, sample_rate = torchaudio.load(file_path)
     waveform = waveform.squeeze(0)
     inputs = processor(waveform, sampling_rate=sample_rate, return_tensors="pt", padding=True)
@@ -44,21 +44,7 @@ def transcribe_wav2vec(model, file_path):
     return transcription
 
 def calculate_wer(transcribed_text, reference_text):
-    transcribed_words = transcribed_text.split()
-    reference_words = reference_text.split()
-    d = np.zeros((len(reference_words) + 1, len(transcribed_words) + 1), dtype=np.uint8)
-    for i in range(1, len(reference_words) + 1):
-        d[i][0] = i
-    for j in range(1, len(transcribed_words) + 1):
-        d[0][j] = j
-    for i in range(1, len(reference_words) + 1):
-        for j in range(1, len(transcribed_words) + 1):
-            if reference_words[i - 1] == transcribed_words[j - 1]:
-                d[i][j] = d[i - 1][j - 1]
-            else:
-                d[i][j] = min(d[i - 1][j] + 1, d[i][j - 1] + 1, d[i - 1][j - 1] + 1)
-    wer = d[len(reference_words)][len(transcribed_words)] / float(len(reference_words))
-    return wer
+    return scoring.score(reference_text, transcribed_text)['wer']
 
 def tensor_to_audio(x, s):
   if len(x.shape) != 2:
@@ -67,16 +53,7 @@ def tensor_to_audio(x, s):
   print("denoised audio saved")
 
 def calculate_accuracy(transcribed_text, reference_text):
-    transcribed_words = transcribed_text.split()
-    reference_words = reference_text.split()
-    
-    matcher = difflib.SequenceMatcher(None, transcribed_words, reference_words)
-    matching_blocks = matcher.get_matching_blocks()
-    
-    match_count = sum(tr.size for tr in matching_blocks)
-    accuracy = (match_count / len(reference_words)) * 100 if reference_words else 0
-
-    return accuracy
+    return scoring.score(reference_text, transcribed_text)['accuracy']
 
 if __name__ == "__main__":
     denoised_audio_path = "denoised.wav"
@@ -120,12 +97,12 @@ if __name__ == "__main__":
     model_name = "facebook/wav2vec2-base-960h"
     processor = Wav2Vec2Processor.from_pretrained(model_name)
     model = Wav2Vec2ForCTC.from_pretrained(model_name)
-    original_transcribed_text = transcribe_wav2vec(model, "formated_"+original_audio_path)
+    original_transcribed_text = transcribe_wav2vec(model, processor, "formated_"+original_audio_path)
     original_wer = calculate_wer(original_transcribed_text.lower(), reference_text.lower())
     original_accuracy = calculate_accuracy(original_transcribed_text.lower(), reference_text.lower())
     print(f"original WER: {original_wer:.2f}%, original accuracy: {original_accuracy:.2f}%")
 
-    denoised_transcribed_text = transcribe_wav2vec(model, "formated_"+denoised_audio_path)
+    denoised_transcribed_text = transcribe_wav2vec(model, processor, "formated_"+denoised_audio_path)
     denoised_wer = calculate_wer(denoised_transcribed_text.lower(), reference_text.lower())
     denoised_accuracy = calculate_accuracy(denoised_transcribed_text.lower(), reference_text.lower())
     print(f"denoised WER: {denoised_wer:.2f}%, denoised accuracy: {denoised_accuracy:.2f}%")
@@ -0,0 +1,98 @@
+## Checks that Demucs loads checkpoints in the facebookresearch/denoiser format,
+## whose state dicts have no resampler kernels, and ones saved while the kernel
+## was still a persistent buffer. The upstream-format checkpoints are also saved
+## in both the zip and the legacy format to a scratch model directory and loaded
+## by name through the registry (hash check, memory-mapped load and `.mmap` copy).
+## Exits with status 1 if any check fails.
+##
+##   python testing/checkpoint_loading.py
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import torch
+
+from denoising.demucs import Demucs, load_pretrained_demucs
+
+CONFIGS = [dict(hidden=48), dict(hidden=64, causal=False, stride=2, resample=2), dict(hidden=32, resample=1)]
+
+
+def facebook_state(kwargs):
+    """A state dict with the keys and shapes of an upstream checkpoint for `kwargs`."""
+    torch.manual_seed(0)
+    state = Demucs(**kwargs).state_dict()
+    return {key: value for key, value in state.items() if not key.endswith('sample.kernel')}
+
+
+def check(name, kwargs, state):
+    model = Demucs(**kwargs)
+    try:
+        model.load_state_dict(state, assign=True)
+    except RuntimeError as e:
+        print(f'{name}: FAIL {e}')
+        return False
+    same = all(torch.equal(model.state_dict()[key], value) for key, value in state.items() if key in model.state_dict())
+    print(f'{name}: {"ok" if same else "FAIL weights differ"}')
+    return same
+
+
+def check_registry(name, kwargs, state, directory, legacy):
+    path = os.path.join(directory, f'{name}.th')
+    # facebook checkpoints are plain state dicts, older ones in the legacy (non zip) format
+    torch.save(state, path, _use_new_zipfile_serialization=not legacy)
+    with open(path, 'rb') as f:
+        filename = f'{name}-{hashlib.sha256(f.read()).hexdigest()[:16]}.th'
+    os.replace(path, os.path.join(directory, filename))
+    local = os.path.join(directory, 'registry.json')
+    entries = {}
+    if os.path.exists(local):
+        with open(local) as f:
+            entries = json.load(f)
+    entries[name] = dict(file=filename, kwargs=kwargs)
+    with open(local, 'w') as f:
+        json.dump(entries, f)
+
+    label = f'{kwargs} {"legacy" if legacy else "zip"} via registry'
+    # twice: the second load goes through the `.verified` marker (and `.mmap` copy)
+    for attempt in ('first', 'cached'):
+        try:
+            model = load_pretrained_demucs(name)
+        except Exception as e:
+            print(f'{label} ({attempt}): FAIL {type(e).__name__}: {e}')
+            return False
+        if not all(torch.equal(model.state_dict()[key], value) for key, value in state.items()):
+            print(f'{label} ({attempt}): FAIL weights differ')
+            return False
+    print(f'{label}: ok')
+    return True
+
+
+if __name__ == '__main__':
+    ok = True
+    directory = tempfile.mkdtemp()
+    os.environ['DENOISER_MODEL_DIR'] = directory
+    os.environ['DENOISER_OFFLINE'] = '1'
+    for index, kwargs in enumerate(CONFIGS):
+        state = facebook_state(kwargs)
+        model = Demucs(**kwargs)
+        kernels = [key for key in model.state_dict() if key.endswith('kernel')]
+        if kernels:
+            print(f'{kwargs}: FAIL resampler kernels in the state dict: {kernels}')
+            ok = False
+        ok &= check(f'{kwargs} facebook format', kwargs, state)
+        # as saved while the kernel was a persistent buffer
+        with_kernels = dict(state)
+        for module in ('upsample', 'downsample'):
+            if hasattr(getattr(model, module), 'kernel'):
+                with_kernels[f'{module}.kernel'] = getattr(model, module).kernel.clone()
+        ok &= check(f'{kwargs} with kernels', kwargs, with_kernels)
+        ok &= check_registry(f'smoke{index}', kwargs, state, directory, legacy=False)
+        ok &= check_registry(f'smoke{index}_legacy', kwargs, state, directory, legacy=True)
+    shutil.rmtree(directory)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,32 @@
+## Checks that chunked inference (denoising/inference.py, default window and hop)
+## matches whole-file inference within CHUNKED_TOLERANCE for every shipped variant,
+## on the recordings in the repo. Prints the measured deviation of each variant and
+## exits with status 1 if any exceeds the tolerance.
+##
+##   python testing/chunked_tolerance.py [variants...]
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from denoising import variants
+from denoising.inference import CHUNKED_TOLERANCE, chunked_deviation
+
+RECORDINGS = [variants.CALIBRATION_AUDIO,
+              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'english27_audio.wav')]
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(variants.VARIANTS)
+    audio = [variants.load_calibration_audio(path).mean(0) for path in RECORDINGS]
+    failed = []
+    for name in names:
+        model = variants.build_variant(name, calibration_cache='.calibration')
+        model.eval()
+        deviation = max(chunked_deviation(model, clip) for clip in audio)
+        status = 'ok' if deviation <= CHUNKED_TOLERANCE else 'FAIL'
+        print(f'{name:>20}: {deviation:.5f} (tolerance {CHUNKED_TOLERANCE}) {status}')
+        if deviation > CHUNKED_TOLERANCE:
+            failed.append(name)
+    sys.exit(1 if failed else 0)
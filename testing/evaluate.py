@@ -0,0 +1,133 @@
+## PESQ / STOI / SI-SNR evaluation of model variants on the Valentini test set
+## The test set is decoded and resampled to 16 kHz once into a memory-mapped store
+## (see data/valentini/dataset.py), inference runs in length-bucketed batches,
+## scoring fans out over a process pool, and scores are memoized per (model, file), so adding a variant only scores that variant.
+##
+##   python testing/evaluate.py noisy pretrained static_full --max-files 400 --csv results.csv
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+import torch
+
+from data.valentini import dataset
+from denoising import metrics, variants
+from denoising.inference import denoise_batch
+
+SAMPLE_RATE = 16000
+CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.eval_cache', 'scores.jsonl')
+
+
+def model_key(name):
+    # scores are invalidated whenever anything the variant is built from changes
+    if name == 'noisy':
+        return name
+    return f'{name}-{variants.fingerprint(name)[:12]}'
+
+
+def load_scores(path=CACHE):
+    scores = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line cut short by an interrupted run
+                    continue
+                scores[(entry['model'], entry['file'])] = entry['scores']
+    return scores
+
+
+def score_pair(denoised, clean):
+    return metrics.score(denoised, clean, SAMPLE_RATE)
+
+
+def evaluate(names, max_files=None, batch_size=16, workers=None, calibration_cache='.calibration'):
+    testset = dataset.indexed_testset(SAMPLE_RATE)
+    files = testset.names[:max_files]
+    scores = load_scores()
+    os.makedirs(os.path.dirname(CACHE), exist_ok=True)
+
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    with pool, open(CACHE, 'a') as cache:
+        for name in names:
+            key = model_key(name)
+            todo = [i for i, file in enumerate(files) if (key, file) not in scores]
+            print(f'{name}: {len(files) - len(todo)} cached, {len(todo)} to score')
+            if not todo:
+                continue
+
+            if name == 'noisy':
+                model = None
+            else:
+                model = variants.build_variant(name, calibration_cache=calibration_cache)
+                model.eval()
+
+            # neighbouring clips in length order pad the least when batched
+            todo.sort(key=lambda i: testset.lengths[i])
+            futures = {}
+
+            def record(future):
+                # each score is written as soon as it is done, so an interrupted run keeps it
+                i = futures.pop(future)
+                scores[(key, files[i])] = future.result()
+                cache.write(json.dumps(dict(model=key, file=files[i], scores=scores[(key, files[i])])) + '\n')
+                cache.flush()
+
+            for start in range(0, len(todo), batch_size):
+                batch = todo[start:start + batch_size]
+                noisy = [testset[i][0] for i in batch]
+                denoised = noisy if model is None else denoise_batch(model, noisy, batch_size)
+                # score this batch in the background while the next one runs
+                for i, out in zip(batch, denoised):
+                    futures[pool.submit(score_pair, out.numpy(), testset[i][1].numpy())] = i
+                for future in [future for future in futures if future.done()]:
+                    record(future)
+
+            for future in as_completed(list(futures)):
+                record(future)
+
+    results = []
+    for name in names:
+        key = model_key(name)
+        values = {metric: np.array([scores[(key, file)][metric] for file in files])
+                  for metric in ('pesq', 'stoi', 'snr')}
+        row = dict(model=name)
+        for metric, value in values.items():
+            row[metric] = float(np.nanmean(value))
+            row[f'{metric}_std'] = float(np.nanstd(value))
+        results.append(row)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score model variants on the Valentini test set.')
+    parser.add_argument('models', nargs='*', help=f"noisy or any of {', '.join(variants.VARIANTS)} (default: all)")
+    parser.add_argument('--max-files', type=int)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--workers', type=int, help='scoring processes (default: one per core)')
+    parser.add_argument('--csv', help='write the summary table as CSV')
+    args = parser.parse_args()
+
+    torch.set_num_threads(os.cpu_count() or 1)
+    names = args.models or ['noisy', *variants.VARIANTS]
+    results = evaluate(names, args.max_files, args.batch_size, args.workers)
+
+    columns = ['model', 'pesq', 'pesq_std', 'stoi', 'stoi_std', 'snr', 'snr_std']
+    print(' '.join(f'{c:>20}' for c in columns))
+    for row in results:
+        print(' '.join(f'{row[c]:>20}' if c == 'model' else f'{row[c]:>20.4f}' for c in columns))
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(results)
@@ -0,0 +1,52 @@
+## End to end check of structured pruning (denoising/pruning.py) on a pretrained
+## model: pruning to the full widths reproduces the model, prune_to_budget meets
+## a FLOP budget of half the model's, and the result survives save_pruned /
+## load_pruned. Exits with status 1 on the first failure.
+##
+##   python testing/pruning_check.py [name]
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import torch
+
+from denoising import pruning
+from denoising.demucs import load_pretrained_demucs
+
+
+def fail(message):
+    print(f'FAIL {message}')
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    name = sys.argv[1] if len(sys.argv) > 1 else 'dns48'
+    model = load_pretrained_demucs(name).eval()
+    torch.manual_seed(0)
+    x = 0.1 * torch.randn(1, 1, model.sample_rate)
+    with torch.no_grad():
+        expected = model(x)
+
+        full = pruning.prune(model, pruning.widths(model)).eval()
+        if not torch.allclose(full(x), expected, atol=1e-5):
+            fail('pruning to the full widths changes the output')
+        print('full widths: ok')
+
+        budget = pruning.count_flops(model) / 2
+        pruned, spec = pruning.prune_to_budget(model, flops=budget)
+        flops = pruning.count_flops(pruned)
+        if flops > budget:
+            fail(f'{flops:.4g} FLOPs, over the budget of {budget:.4g}')
+        if pruned(x).shape != expected.shape:
+            fail(f'output shape {tuple(pruned(x).shape)}, expected {tuple(expected.shape)}')
+        print(f'prune_to_budget: ok, {flops / 1e9:.3f} of {2 * budget / 1e9:.3f} GFLOPs, spec {spec}')
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'pruned.pt')
+            pruning.save_pruned(pruned, spec, path)
+            if not torch.equal(pruning.load_pruned(path).eval()(x), pruned(x)):
+                fail('the reloaded model differs')
+        print('save_pruned / load_pruned: ok')
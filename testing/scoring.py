@@ -0,0 +1,90 @@
+## Word level scoring of transcripts: WER, accuracy, and the substitution /
+## insertion / deletion breakdown, for single pairs or whole corpora.
+## The edit distance keeps one row of the table at a time (linear memory) and
+## computes each row with numpy, including the insertion chain, which is a
+## running minimum; see align().
+
+import numpy as np
+
+
+def align(reference, hypothesis):
+    """
+    Minimum edit alignment between two word lists. Returns the number of
+    hits, substitutions, deletions (reference words missing from the
+    hypothesis) and insertions (extra hypothesis words), using int64 counts.
+    """
+    # the python loop runs over the outer list, so make it the shorter one
+    swapped = len(reference) > len(hypothesis)
+    if swapped:
+        reference, hypothesis = hypothesis, reference
+
+    vocabulary = {}
+    ref = np.array([vocabulary.setdefault(w, len(vocabulary)) for w in reference], dtype=np.int64)
+    hyp = np.array([vocabulary.setdefault(w, len(vocabulary)) for w in hypothesis], dtype=np.int64)
+
+    m = len(hyp)
+    positions = np.arange(m + 1, dtype=np.int64)
+    # edit counts of the best path to every cell of the current row
+    subs = np.zeros(m + 1, dtype=np.int64)
+    dels = np.zeros(m + 1, dtype=np.int64)
+    ins = positions.copy()
+    cost = positions.copy()
+
+    for word in ref:
+        mismatch = (hyp != word).astype(np.int64)
+        diagonal = cost[:-1] + mismatch
+        up = cost[1:] + 1
+        use_diagonal = diagonal <= up
+
+        # best path into each cell without a horizontal (insertion) step
+        best = np.empty(m + 1, dtype=np.int64)
+        best[0] = cost[0] + 1
+        best[1:] = np.where(use_diagonal, diagonal, up)
+        best_subs = np.concatenate([subs[:1], np.where(use_diagonal, subs[:-1] + mismatch, subs[1:])])
+        best_dels = np.concatenate([dels[:1] + 1, np.where(use_diagonal, dels[:-1], dels[1:] + 1)])
+        best_ins = np.concatenate([ins[:1], np.where(use_diagonal, ins[:-1], ins[1:])])
+
+        # cost[j] = min over k <= j of best[k] + (j - k): a running minimum of
+        # best[k] - k. source[j] is the latest k reaching it, i.e. the path
+        # with the fewest trailing insertions.
+        shifted = best - positions
+        running = np.minimum.accumulate(shifted)
+        source = np.maximum.accumulate(np.where(shifted == running, positions, 0))
+        cost = running + positions
+        subs = best_subs[source]
+        dels = best_dels[source]
+        ins = best_ins[source] + positions - source
+
+    substitutions, deletions, insertions = int(subs[-1]), int(dels[-1]), int(ins[-1])
+    if swapped:
+        deletions, insertions = insertions, deletions
+    hits = (len(hypothesis) if swapped else len(reference)) - substitutions - deletions
+    return dict(hits=hits, substitutions=substitutions, deletions=deletions, insertions=insertions)
+
+
+def score(reference_text, hypothesis_text):
+    """Alignment counts, WER and accuracy (percentage of reference words recognized) of one pair."""
+    reference = reference_text.split()
+    counts = align(reference, hypothesis_text.split())
+    counts['reference_words'] = len(reference)
+    return _rates(counts)
+
+
+def _rates(counts):
+    n = counts['reference_words']
+    errors = counts['substitutions'] + counts['deletions'] + counts['insertions']
+    counts['wer'] = errors / n if n else float('inf') if errors else 0.
+    counts['accuracy'] = counts['hits'] / n * 100 if n else 0.
+    return counts
+
+
+def score_corpus(pairs):
+    """
+    Score an iterable of (reference, hypothesis) text pairs. Returns the
+    per pair scores and the corpus totals, whose WER is the total error count
+    over the total number of reference words.
+    """
+    scores = [score(reference, hypothesis) for reference, hypothesis in pairs]
+    keys = ('hits', 'substitutions', 'deletions', 'insertions', 'reference_words')
+    total = _rates({key: sum(s[key] for s in scores) for key in keys})
+    return dict(pairs=scores, total=total)
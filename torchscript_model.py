@@ -1,37 +1,96 @@
+"""
+Export model variants as lite-interpreter TorchScript for the Android app.
+
+    python torchscript_model.py                      # every variant
+    python torchscript_model.py static_only pretrained --jobs 2
+
+Variants whose inputs (weights, quantization recipe, calibration audio, torch
+version, model code) have not changed since the last export are skipped;
+use --force to rebuild them anyway.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import torch
-import torchaudio
-from torchaudio.functional import resample
 from torch.utils.mobile_optimizer import optimize_for_mobile
-import sys
-
-from denoising import demucs, quantized_demucs
-
-noisy, fs = torchaudio.load("alex_noisy.mp3")
-noisy = resample(noisy, fs, 16000)
-
-
-all_models = {
-    "pretrained": lambda: demucs.load_pretrained_demucs(
-        "dns48"
-    ),  # no quantization, base model
-    "dynamic_only": lambda: quantized_demucs.QuantizedDemucs.from_facebook_pretrained(
-        "dns48", dict(encoder=False, lstm=False), dynamic=torch.qint8
-    ),  # dynamic lstm
-    "static_only": lambda: quantized_demucs.QuantizedDemucs.from_facebook_pretrained(
-        "dns48", dict(encoder=True, lstm=True), dynamic=None, sample_audio=noisy
-    ),  # static encoder + static lstm
-    "static_encoder_only": lambda: quantized_demucs.QuantizedDemucs.from_facebook_pretrained(
-        "dns48", dict(encoder=True, lstm=False), dynamic=None, sample_audio=noisy
-    ),  # static encoder
-    "static_lstm_only": lambda: quantized_demucs.QuantizedDemucs.from_facebook_pretrained(
-        "dns48", dict(encoder=False, lstm=True), dynamic=None, sample_audio=noisy
-    ),  # static lstm
-    "static_and_dynamic": lambda: quantized_demucs.QuantizedDemucs.from_facebook_pretrained(
-        "dns48", dict(encoder=True, lstm=False), dynamic=torch.qint8, sample_audio=noisy
-    ),  # static encoder + dynamic lstm
-}
-
-variant = sys.argv[1]
-as_script = torch.jit.script(all_models[variant]())
-optimized = optimize_for_mobile(as_script)
-optimized._save_for_lite_interpreter(f"android/app/src/main/assets/{variant}.ptl")
+
+from denoising import variants
+
+CALIBRATION_CACHE = ".calibration"
+OUTPUT_DIR = "android/app/src/main/assets"
+# kept out of the assets directory so it does not end up in the APK
+MANIFEST = ".export_manifest.json"
+
+_sample_audio = None
+
+
+def _init_worker(sample_audio: torch.Tensor, threads: int):
+    global _sample_audio
+    _sample_audio = sample_audio
+    torch.set_num_threads(threads)
+
+
+def export(variant: str, output_dir: str) -> str:
+    model = variants.build_variant(variant, _sample_audio, calibration_cache=CALIBRATION_CACHE)
+    as_script = torch.jit.script(model)
+    optimized = optimize_for_mobile(as_script)
+    optimized._save_for_lite_interpreter(os.path.join(output_dir, f"{variant}.ptl"))
+    return variant
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export model variants for the Android app.")
+    parser.add_argument("variants", nargs="*",
+                        help=f"variants to export, out of {', '.join(variants.VARIANTS)} (default: all)")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--jobs", type=int, default=min(4, os.cpu_count() or 1),
+                        help="number of variants exported in parallel")
+    parser.add_argument("--force", action="store_true", help="rebuild up to date variants")
+    args = parser.parse_args()
+
+    selected = args.variants or list(variants.VARIANTS)
+    unknown = [v for v in selected if v not in variants.VARIANTS]
+    if unknown:
+        parser.error(f"unknown variants: {', '.join(unknown)}")
+    sample_audio = variants.load_calibration_audio()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifests = {}
+    if os.path.exists(MANIFEST):
+        with open(MANIFEST) as f:
+            manifests = json.load(f)
+    manifest = manifests.setdefault(os.path.abspath(args.output_dir), {})
+
+    fingerprints = {v: variants.fingerprint(v, sample_audio) for v in selected}
+    todo = [v for v in selected
+            if args.force
+            or manifest.get(v) != fingerprints[v]
+            or not os.path.exists(os.path.join(args.output_dir, f"{v}.ptl"))]
+    for v in selected:
+        if v not in todo:
+            print(f"{v}: up to date")
+    if not todo:
+        return
+
+    jobs = max(1, min(args.jobs, len(todo)))
+    threads = max(1, (os.cpu_count() or 1) // jobs)
+    # spawn, since forking a process that already ran torch ops can deadlock
+    with ProcessPoolExecutor(max_workers=jobs,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker,
+                             initargs=(sample_audio, threads)) as pool:
+        futures = [pool.submit(export, v, args.output_dir) for v in todo]
+        for future in futures:
+            variant = future.result()
+            manifest[variant] = fingerprints[variant]
+            # written after every variant so a failure keeps finished ones
+            with open(MANIFEST, "w") as f:
+                json.dump(manifests, f, indent=2, sort_keys=True)
+            print(f"{variant}: exported")
+
+
+if __name__ == "__main__":
+    main()
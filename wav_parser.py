@@ -1,44 +1,152 @@
 # takes .wav files and returns (1) audio samples (2) frame rate
+# the data chunk is memory mapped and exposed as a numpy view, nothing is read up front
 
-import wave
+import os
+import struct
 import numpy as np
 
-def parse_wav_file(file_path):
-    try:
-        # Open the WAV file
-        with wave.open(file_path, 'rb') as wav_file:
-            # Get audio file properties
-            num_channels = wav_file.getnchannels()
-            sample_width = wav_file.getsampwidth()
-            frame_rate = wav_file.getframerate()
-            num_frames = wav_file.getnframes()
-
-            # Read audio frames
-            raw_frames = wav_file.readframes(num_frames)
-
-        # Convert raw data to numpy array based on sample width
-        if sample_width == 1:
-            dtype = np.uint8
-        elif sample_width == 2:
-            dtype = np.int16
-        elif sample_width == 3:
-            dtype = np.int32  # Special case for 24-bit audio (not common)
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# sample dtypes that can be viewed in place, by (format, sample width)
+DTYPES = {
+    (WAVE_FORMAT_PCM, 1): np.uint8,
+    (WAVE_FORMAT_PCM, 2): np.dtype('<i2'),
+    (WAVE_FORMAT_PCM, 4): np.dtype('<i4'),
+    (WAVE_FORMAT_IEEE_FLOAT, 4): np.dtype('<f4'),
+    (WAVE_FORMAT_IEEE_FLOAT, 8): np.dtype('<f8'),
+}
+
+
+def decode_24bit(samples):
+    """int32 values of [..., 3] little endian 24-bit samples."""
+    b = samples.astype(np.int32)
+    # assemble the word in the top 3 bytes, then sign extend with an arithmetic shift
+    return ((b[..., 0] << 8) | (b[..., 1] << 16) | (b[..., 2] << 24)) >> 8
+
+
+class WavFile:
+    """
+    A WAV file (path or bytes) whose data chunk is memory mapped.
+
+    `samples` is a zero-copy [frames, channels] view of the stored samples
+    (24-bit audio, which has no numpy dtype, is viewed as [frames, channels, 3]
+    bytes), `read` decodes a range of frames to normalized float32 and
+    `blocks` iterates over the file in fixed size pieces.
+    """
+    def __init__(self, source):
+        if isinstance(source, (str, os.PathLike)):
+            # copy on write, so torch.from_numpy can wrap the views without copying
+            self._buffer = np.memmap(source, dtype=np.uint8, mode='c')
+        else:
+            self._buffer = np.frombuffer(source, dtype=np.uint8)
+        self._parse()
+
+    def _read(self, offset, fmt):
+        size = struct.calcsize(fmt)
+        if offset + size > len(self._buffer):
+            raise ValueError("truncated WAV file")
+        return struct.unpack(fmt, self._buffer[offset:offset + size].tobytes())
+
+    def _parse(self):
+        riff, _, wave_id = self._read(0, '<4sI4s')
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            raise ValueError("not a RIFF/WAVE file")
+
+        fmt = None
+        offset = 12
+        while offset + 8 <= len(self._buffer):
+            chunk_id, size = self._read(offset, '<4sI')
+            body = offset + 8
+            if chunk_id == b'fmt ':
+                fmt = self._read(body, '<HHIIHH')
+                if fmt[0] == WAVE_FORMAT_EXTENSIBLE:
+                    # the real format is the first field of the sub format GUID
+                    fmt = (self._read(body + 24, '<H')[0],) + fmt[1:]
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError("data chunk before fmt chunk")
+                # streamed files may leave the size unset, take the rest of the file
+                self._data = (body, min(body + size, len(self._buffer)))
+                break
+            offset = body + size + (size & 1)
+        else:
+            raise ValueError("no data chunk")
+
+        self.format, self.channels, self.sample_rate, _, self.block_align, _ = fmt
+        if self.channels == 0 or self.block_align % self.channels:
+            raise ValueError(f"block align {self.block_align} does not fit {self.channels} channels")
+        # the container size, which is what strides through the data; valid bits
+        # that do not fill it (e.g. 20 of 24) are left justified, so they decode
+        # like a full container
+        self.sample_width = self.block_align // self.channels
+        if self.format not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+            raise ValueError(f"unsupported WAV format {self.format:#x}")
+        if (self.format, self.sample_width) not in DTYPES and (self.format, self.sample_width) != (WAVE_FORMAT_PCM, 3):
+            raise ValueError(f"unsupported sample width {self.sample_width}")
+
+        start, end = self._data
+        self.num_frames = (end - start) // self.block_align
+        self._data = (start, start + self.num_frames * self.block_align)
+
+    @property
+    def duration(self):
+        return self.num_frames / self.sample_rate
+
+    @property
+    def samples(self):
+        start, end = self._data
+        data = self._buffer[start:end]
+        if self.sample_width == 3:
+            return data.reshape(-1, self.channels, 3)
+        return data.view(DTYPES[(self.format, self.sample_width)]).reshape(-1, self.channels)
+
+    def read(self, start=0, stop=None, mono=False):
+        """Frames [start, stop) as float32 in [-1, 1), of shape [frames, channels] or [frames] if mono."""
+        samples = self.samples[start:stop]
+        if self.sample_width == 1:
+            out = (samples.astype(np.float32) - 128) / 128
+        elif self.sample_width == 3:
+            out = decode_24bit(samples).astype(np.float32) / 2 ** 23
+        elif self.format == WAVE_FORMAT_PCM:
+            out = samples.astype(np.float32) / 2 ** (8 * self.sample_width - 1)
         else:
-            raise ValueError("Unsupported sample width")
+            out = samples.astype(np.float32)
+        return out.mean(axis=1) if mono else out
+
+    def blocks(self, block_size=1 << 16, mono=False):
+        """Iterate over the whole file in pieces of `block_size` frames, see `read`."""
+        for start in range(0, self.num_frames, block_size):
+            yield self.read(start, start + block_size, mono)
 
-        # Convert raw data to numpy array
-        samples = np.frombuffer(raw_frames, dtype=dtype)
 
-        # Reshape array based on number of channels
-        if num_channels > 1:
-            samples = samples.reshape(-1, num_channels)
+def parse_wav_file(file_path):
+    """
+    Stored samples and frame rate of a WAV file, as a [frames] array for mono
+    files and [frames, channels] otherwise. 24-bit samples are decoded to
+    int32. Errors are raised, not swallowed.
+    """
+    wav = WavFile(file_path)
+    samples = wav.samples
+    if wav.sample_width == 3:
+        samples = decode_24bit(samples)
+    if wav.channels == 1:
+        samples = samples[:, 0]
+    return samples, wav.sample_rate
+
 
-        return samples, frame_rate
+def wav_header(num_frames, sample_rate, channels=1, sample_width=2):
+    """Header of a PCM WAV file, for writing (or streaming) the samples after it."""
+    data_size = num_frames * channels * sample_width
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+                       b'RIFF', 36 + data_size, b'WAVE',
+                       b'fmt ', 16, WAVE_FORMAT_PCM, channels, sample_rate,
+                       sample_rate * channels * sample_width, channels * sample_width, 8 * sample_width,
+                       b'data', data_size)
 
-    except Exception as e:
-        print(f"Error parsing {file_path}: {e}")
-        return None, None
 
-# sample usage
-file_path = 'data/nick/street_1.wav'
-samples, frame_rate = parse_wav_file(file_path)
\ No newline at end of file
+def to_pcm16(samples):
+    """Little endian 16-bit PCM bytes of float samples in [-1, 1]."""
+    samples = np.clip(np.asarray(samples, dtype=np.float32), -1, 1)
+    return np.round(samples * 32767).astype('<i2').tobytes()